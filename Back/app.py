@@ -1,6 +1,7 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
+import asyncio
 
 # For admin panel
 from sqladmin import Admin, ModelView
@@ -8,26 +9,69 @@ from Back.db.database import engine
 from Back.db.models import User
 
 # Routers
-from Back.routers import login, upload, tools, profile
+from Back.routers import login, upload, tools, profile, jobs, bouncer, reports, records
 
 # Modules
-from Back.core.pipeline import load_models
+from Back.core.executor import create_executor
+from Back.core.batcher import create_batcher
+from Back.core.merge import create_merge_pool
+from Back.services.result_cache import create_result_cache
+from Back.services.blob_store import create_blob_store
+from Back.services.user_cache import listen_for_invalidations, invalidate_user
+from Back.services.revocation_filter import sync_revoked_tokens
 from Back.db.database import create_db_and_tables
 
+async def start_inference(app: FastAPI):
+  """
+  Loads + warms up the models in the background, /ready returns 503 until it's done
+  """
+  try:
+    await app.state.inference.start()
+  
+  except Exception as e:
+    print(f"Failed to start the inference workers, Error: {e}")
+    return
+  
+  # hunter batching between concurrent requests (None if turned off)
+  app.state.hunter_batcher = create_batcher(app.state.inference)
+  app.state.ready = True
+  print("Models are loaded and warm, ready for traffic")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
   
-  # 1- Load all models (yolo + ocr)
-  hunter, surgeon, reader = await load_models()
+  # 1- Start the inference workers (each one loads its own models: yolo + ocr)
+  app.state.ready = False
+  app.state.hunter_batcher = None
+  app.state.inference = create_executor()
+  app.state.result_cache = create_result_cache() # None if turned off
+  app.state.merge_pool = create_merge_pool() # None if turned off
+  app.state.blob_store = create_blob_store() # None if turned off
   
-  app.state.hunter_model = hunter
-  app.state.surgeon_model = surgeon
-  app.state.reader = reader
+  startup = asyncio.create_task(start_inference(app))
+  
+  # user cache invalidations from the other api processes (the cache is off until it's subscribed)
+  user_cache_listener = asyncio.create_task(listen_for_invalidations())
+  
+  # local filter of the revoked tokens (every check goes to redis until it's synced)
+  revoked_tokens_sync = asyncio.create_task(sync_revoked_tokens())
   
   # 2- create db
   await create_db_and_tables()
 
   yield
+  
+  startup.cancel()
+  user_cache_listener.cancel()
+  revoked_tokens_sync.cancel()
+  
+  if app.state.hunter_batcher:
+    app.state.hunter_batcher.stop()
+  
+  app.state.inference.shutdown()
+  
+  if app.state.merge_pool:
+    app.state.merge_pool.shutdown(cancel_futures=True)
 
 app = FastAPI(lifespan=lifespan)
 
@@ -52,6 +96,10 @@ app.include_router(login.router)
 app.include_router(upload.router)
 app.include_router(profile.router)
 app.include_router(tools.router)
+app.include_router(jobs.router)
+app.include_router(reports.router)
+app.include_router(records.router)
+app.include_router(bouncer.router)
 
 #  ADMIN PANEL SETUP
 class UserAdmin(ModelView, model=User):
@@ -62,6 +110,13 @@ class UserAdmin(ModelView, model=User):
   can_delete = True
   
   icon = "fa-solid fa-user"
+  
+  # edits (deactivate, unlimited, counters...) must reach the user cache of every api process
+  async def after_model_change(self, data, model, is_created, request):
+    await invalidate_user() # everyone, the username itself may have been edited
+  
+  async def after_model_delete(self, model, request):
+    await invalidate_user(model.username)
 
 # This adds the /admin route
 authentication_backend = None
@@ -0,0 +1,162 @@
+from ultralytics import YOLO
+import easyocr
+
+import os
+import cv2
+
+# "torch" (default) | "onnx" | "openvino"
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")
+
+# "auto" -> gpu for the torch backend, cpu for the exported ones (they are meant for cpu nodes)
+OCR_GPU = os.getenv("OCR_GPU", "auto")
+
+# "fp32" (default) | "int8" -> loads the quantized openvino models made by trainers/quantize.py
+MODEL_PRECISION = os.getenv("MODEL_PRECISION", "fp32")
+
+# sheet used at startup to check that the exported models give the same detections as pytorch
+BACKEND_CHECK_IMAGE = os.getenv("BACKEND_CHECK_IMAGE", "./models/reference_sheet.jpg")
+BACKEND_CHECK_IOU = float(os.getenv("BACKEND_CHECK_IOU", 0.9))
+
+# weights -> "backend/precision" that was really loaded for them in this process (after the fallbacks)
+loaded_backends = {}
+
+def loaded_backend():
+  """
+  What the models of this process really run on, eg. "hunter.pt:openvino/int8,surgeon.pt:torch/fp32"
+  """
+  return ",".join(f"{os.path.basename(weights)}:{backend}" for weights, backend in sorted(loaded_backends.items()))
+
+def export_path(weights, backend, precision="fp32"):
+  """
+  Where ultralytics saves the exported model (next to the .pt file)
+  """
+  base = os.path.splitext(weights)[0]
+
+  if precision == "int8":
+    return base + "_int8_openvino_model"
+
+  if backend == "onnx":
+    return base + ".onnx"
+
+  return base + "_openvino_model"
+
+def load_yolo(weights, backend=INFERENCE_BACKEND, precision=MODEL_PRECISION):
+  """
+  1- Export the weights to the backend (only the first time)
+  2- Load the exported model
+  3- Fall back to pytorch if anything fails
+
+  int8 models are not exported here (they need the calibration data), see trainers/quantize.py
+  """
+  if precision == "int8":
+    quantized = export_path(weights, backend, precision)
+
+    if os.path.exists(quantized):
+      loaded_backends[weights] = f"{backend}/int8"
+      return YOLO(quantized, task="detect")
+
+    print(f"WARNING: no int8 model at {quantized} (run trainers/quantize.py), using {backend} fp32")
+
+  if backend == "torch":
+    loaded_backends[weights] = "torch/fp32"
+    return YOLO(weights)
+
+  try:
+    # 1- export, dynamic=True so batched calls still work
+    exported = export_path(weights, backend)
+
+    if not os.path.exists(exported):
+      print(f"Exporting {weights} to {backend}...")
+      exported = YOLO(weights).export(format=backend, dynamic=True)
+
+    # 2- load
+    model = YOLO(exported, task="detect")
+    loaded_backends[weights] = f"{backend}/fp32"
+    return model
+
+  except Exception as e:
+    # 3- fallback
+    print(f"Failed to load {backend} model for {weights}, falling back to pytorch. Error: {e}")
+    loaded_backends[weights] = "torch/fp32"
+    return YOLO(weights)
+
+def load_reader(backend=INFERENCE_BACKEND, detector=True):
+  """
+  EasyOCR reader (english + arabic)
+  on cpu easyocr already runs its models dynamically quantized to int8 (its quantize default, unused on gpu)
+  detector=False -> the CRAFT text detector is not loaded at all (OCR_SKIP_DETECTOR only runs the recognizer)
+  """
+  if OCR_GPU == "auto":
+    gpu = backend == "torch"
+  else:
+    gpu = OCR_GPU == "1"
+
+  return easyocr.Reader(['en', 'ar'], gpu=gpu, detector=detector)
+
+def load_reference():
+  """
+  Returns the reference sheet (or None if it's missing)
+  """
+  if not os.path.exists(BACKEND_CHECK_IMAGE):
+    print(f"WARNING: no reference image at {BACKEND_CHECK_IMAGE}, skipping the backend self-check")
+    return None
+
+  return cv2.imread(BACKEND_CHECK_IMAGE)
+
+def box_iou(a, b):
+  x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+  x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+
+  inter = max(0, x2 - x1) * max(0, y2 - y1)
+  union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+
+  return inter / union if union > 0 else 0.0
+
+def detections(model, images):
+  """
+  Returns per image a list of (class_id, [x1, y1, x2, y2])
+  """
+  return [
+    [(int(box.cls[0]), box.xyxy[0].tolist()) for box in result.boxes]
+    for result in model(images, verbose=False)
+  ]
+
+def same_detections(expected, found, iou_threshold=BACKEND_CHECK_IOU):
+  """
+  True if every box has a match with the same class and IoU >= iou_threshold
+  """
+  if len(expected) != len(found):
+    return False
+
+  unmatched = list(found)
+
+  for class_id, box in expected:
+    match = next((f for f in unmatched if f[0] == class_id and box_iou(box, f[1]) >= iou_threshold), None)
+    if match is None:
+      return False
+
+    unmatched.remove(match)
+
+  return True
+
+def check_backend(model, weights, images, backend=INFERENCE_BACKEND):
+  """
+  Compares the model's detections with the pytorch weights on the reference images
+  if they don't match, the pytorch model is returned instead (a backend switch can't silently change results)
+  """
+  if (backend == "torch" and MODEL_PRECISION == "fp32") or not images:
+    return model
+
+  reference_model = YOLO(weights)
+
+  expected = detections(reference_model, images)
+  found = detections(model, images)
+
+  if all(same_detections(e, f) for e, f in zip(expected, found)):
+    print(f"Backend self-check passed for {weights} ({backend}, {MODEL_PRECISION})")
+    return model
+
+  # note: int8 boxes move a bit, BACKEND_CHECK_IOU may need to be lowered for them
+  print(f"WARNING: {backend} ({MODEL_PRECISION}) detections don't match pytorch for {weights}, falling back to pytorch")
+  loaded_backends[weights] = "torch/fp32"
+  return reference_model
@@ -0,0 +1,96 @@
+import asyncio
+import os
+
+# Modules
+from Back.core.executor import hunter_job
+
+# how long the first sheet waits for other requests' sheets before the hunter runs, 0 -> no batching
+HUNTER_BATCH_WINDOW_MS = float(os.getenv("HUNTER_BATCH_WINDOW_MS", 0))
+
+# the batch runs right away once it has this many sheets
+HUNTER_MAX_BATCH = int(os.getenv("HUNTER_MAX_BATCH", 8))
+
+class HunterBatcher:
+  """
+  Collects sheets from concurrent requests and runs the hunter model once for all of them
+  1- The first sheet opens a window of HUNTER_BATCH_WINDOW_MS
+  2- Every sheet that arrives in the window joins the batch (up to HUNTER_MAX_BATCH)
+  3- One hunter_job on the inference workers, then each request gets its own boxes back
+  """
+
+  def __init__(self, inference, window_ms=HUNTER_BATCH_WINDOW_MS, max_batch=HUNTER_MAX_BATCH):
+    self.inference = inference
+    self.window = window_ms / 1000
+    self.max_batch = max_batch
+    self.queue = asyncio.Queue()
+    self.task = None
+    self.running = set() # keeps a reference to the running batches
+
+  def start(self):
+    self.task = asyncio.create_task(self._collect())
+
+  async def detect(self, sheet):
+    """
+    Waits for the sheet's hunter boxes, same format as detect_stickers
+    """
+    future = asyncio.get_running_loop().create_future()
+    await self.queue.put((sheet, future))
+
+    return await future
+
+  async def _collect(self):
+    loop = asyncio.get_running_loop()
+
+    while True:
+
+      # 1- wait for the first sheet
+      batch = [await self.queue.get()]
+      deadline = loop.time() + self.window
+
+      # 2- fill the batch until the window closes
+      while len(batch) < self.max_batch:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+          break
+
+        try:
+          batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+        except asyncio.TimeoutError:
+          break
+
+      # 3- run it without blocking the next window
+      task = asyncio.create_task(self._run(batch))
+      self.running.add(task)
+      task.add_done_callback(self.running.discard)
+
+  async def _run(self, batch):
+    sheets = [sheet for sheet, _ in batch]
+
+    try:
+      results = await self.inference.run(hunter_job, *sheets)
+
+    except Exception as e:
+      for _, future in batch:
+        if not future.done():
+          future.set_exception(e)
+      return
+
+    for (_, future), boxes in zip(batch, results):
+      if not future.done(): # request was cancelled
+        future.set_result(boxes)
+
+  def stop(self):
+    if self.task:
+      self.task.cancel()
+
+def create_batcher(inference):
+  """
+  Returns a running batcher, or None if batching is turned off
+  """
+  if HUNTER_BATCH_WINDOW_MS <= 0:
+    return None
+
+  batcher = HunterBatcher(inference)
+  batcher.start()
+
+  return batcher
@@ -0,0 +1,90 @@
+from io import BytesIO
+import numpy as np
+import cv2
+import os
+
+from PIL import Image
+import pillow_heif
+
+# longest side (px) the uploads are decoded to, 0 -> full resolution
+# the stickers are cut from this image, so don't go too low (the OCR needs the pixels)
+DECODE_MAX_SIDE = int(os.getenv("DECODE_MAX_SIDE", 0))
+
+# jpeg can be decoded at 1/2, 1/4 or 1/8 of its size straight from the DCT (much cheaper than decode + resize)
+JPEG_REDUCED_FLAGS = [
+  (8, cv2.IMREAD_REDUCED_COLOR_8),
+  (4, cv2.IMREAD_REDUCED_COLOR_4),
+  (2, cv2.IMREAD_REDUCED_COLOR_2),
+]
+
+def is_heic(filename, content_type):
+  return content_type in ["image/heic", "image/heif"] or filename.lower().endswith(('.heic', '.heif'))
+
+def is_jpeg(contents):
+  return contents[:3] == b"\xff\xd8\xff"
+
+def fit(image, max_side):
+  """
+  Downscales the image so its longest side is max_side (no copy if it already fits)
+  """
+  h, w = image.shape[:2]
+  scale = max_side / max(h, w)
+
+  if max_side <= 0 or scale >= 1:
+    return image
+
+  return cv2.resize(image, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+
+def decode_heic(contents, max_side):
+  """
+  1- libheif decodes straight into BGR (no PIL image, no RGB -> BGR pass)
+     the container rotation/mirror is applied by libheif, same as the EXIF orientation for jpeg
+  2- Wrap the decoded buffer as a numpy array (no copy unless the rows are padded or there is an alpha channel)
+  3- Downscale if needed
+  """
+  # 1- decode
+  heif_file = pillow_heif.open_heif(contents, convert_hdr_to_8bit=True, bgr_mode=True)
+
+  # 2- wrap
+  image = np.asarray(heif_file)
+  if heif_file.has_alpha: # BGRA, the models and the crops expect 3 channels
+    image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+  elif not image.flags.c_contiguous: # row stride padding
+    image = np.ascontiguousarray(image)
+
+  # 3- reduce
+  return fit(image, max_side)
+
+def decode_jpeg(contents, max_side):
+  """
+  Picks the biggest DCT reduction that still keeps the longest side >= max_side
+  the EXIF orientation is applied by imdecode in the same pass
+  """
+  flag = cv2.IMREAD_COLOR
+
+  if max_side > 0:
+    with Image.open(BytesIO(contents)) as header: # only reads the header
+      longest = max(header.size)
+
+    for factor, reduced_flag in JPEG_REDUCED_FLAGS:
+      if longest // factor >= max_side:
+        flag = reduced_flag
+        break
+
+  image = cv2.imdecode(np.frombuffer(contents, np.uint8), flag)
+  return fit(image, max_side)
+
+def decode_image(contents, filename, content_type, max_side=DECODE_MAX_SIDE):
+  """
+  Decodes the uploaded bytes into an opencv (BGR) array
+  """
+  if is_heic(filename, content_type):
+    print(f"Processing HEIC/HEIF file: {filename}")
+    return decode_heic(contents, max_side)
+
+  if is_jpeg(contents):
+    return decode_jpeg(contents, max_side)
+
+  # png and the rest (EXIF orientation is applied by imdecode)
+  image = cv2.imdecode(np.frombuffer(contents, np.uint8), cv2.IMREAD_COLOR)
+  return fit(image, max_side)
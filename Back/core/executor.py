@@ -0,0 +1,422 @@
+from fastapi import HTTPException, status
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory, get_context
+from collections import namedtuple
+from functools import partial
+import numpy as np
+import threading
+import asyncio
+import queue
+import os
+
+# Modules
+from Back.core.pipeline import load_models, process_sheet, find_stickers, detect_stickers, crop_stickers, read_stickers
+from Back.core.ocr import PREPROCESSORS, ocr_tier_stats, shared_tier_stats, use_shared_tier_counts
+from Back.core.backends import loaded_backend
+
+# "thread" -> worker threads inside the api process
+# "process" -> worker processes (uses all the cores, the GIL is not shared)
+INFERENCE_MODE = os.getenv("INFERENCE_MODE", "thread")
+
+# number of inference threads, each one loads its own copy of the models (watch the RAM)
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 1))
+
+# max number of jobs waiting for a free worker, after that new jobs get a 503
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", 8))
+
+# torch intra-op threads per worker (thread or process), default splits the cores between workers
+INFERENCE_TORCH_THREADS = int(os.getenv("INFERENCE_TORCH_THREADS", max(1, (os.cpu_count() or 1) // INFERENCE_WORKERS)))
+
+# background jobs retry a full queue after this many seconds (doubled every time, up to QUEUE_RETRY_MAX_SECONDS)
+QUEUE_RETRY_SECONDS = 0.2
+QUEUE_RETRY_MAX_SECONDS = 5
+
+Models = namedtuple("Models", ["hunter", "surgeon", "reader"])
+
+# what is sent to / from a worker process instead of the pickled array
+# offset -> position of the array in the block (all the sticker crops of a sheet share one block)
+SharedImage = namedtuple("SharedImage", ["name", "shape", "dtype", "offset"], defaults=(0,))
+
+
+""" JOBS (module level so they can be sent to worker processes) """
+
+# boxes -> hunter results from hunter_job (skips running the hunter again)
+
+def hunter_job(models, *sheets):
+  return detect_stickers(models.hunter, list(sheets))
+
+def sheet_job(models, image, filename, boxes=None):
+  if boxes is None:
+    return process_sheet(image=image, hunter=models.hunter, surgeon=models.surgeon, reader=models.reader, filename=filename)
+
+  return read_stickers(crop_stickers(image, boxes, filename), models.surgeon, models.reader)
+
+def stickers_job(models, image, filename, boxes=None):
+  if boxes is None:
+    return find_stickers(image, models.hunter, filename)
+
+  return crop_stickers(image, boxes, filename)
+
+def read_job(models, stickers):
+  return read_stickers(stickers, models.surgeon, models.reader)
+
+
+def limit_threads(torch_threads):
+  """
+  Sets the torch intra-op threads of the calling worker (openmp keeps the setting per thread)
+  """
+  import torch
+  torch.set_num_threads(torch_threads)
+
+
+""" THREAD WORKERS """
+
+class InferenceExecutor:
+  """
+  Runs the cpu heavy pipeline calls off the event loop
+  every worker thread loads its own models (yolo + easyocr objects are not safe to share between threads)
+  and jobs wait in a bounded queue until a worker is free
+  """
+
+  def __init__(self, workers=INFERENCE_WORKERS, queue_size=INFERENCE_QUEUE_SIZE, torch_threads=INFERENCE_TORCH_THREADS):
+    self.workers = workers
+    self.torch_threads = torch_threads
+    self.jobs = queue.Queue(maxsize=queue_size)
+    self.threads = []
+    self.backend = None # what the models really run on (after the fallbacks), set by start
+
+  async def start(self):
+    """
+    Starts the workers and waits until all of them loaded their models
+    """
+    loaded = []
+
+    for i in range(self.workers):
+      ready = Future()
+
+      thread = threading.Thread(target=self._work, args=(ready,), name=f"inference-{i}", daemon=True)
+      thread.start()
+
+      self.threads.append(thread)
+      loaded.append(asyncio.wrap_future(ready))
+
+    await asyncio.gather(*loaded)
+    self.backend = loaded_backend() # the worker threads loaded them in this process
+
+  def _work(self, ready):
+    """
+    Worker thread loop
+    1- Limit torch to this worker's share of the cores + load the models (once per thread)
+    2- Take a job from the queue and run it with this thread's models
+    3- Send the result (or the error) back to the waiting request
+    """
+
+    # 1- threads + load
+    try:
+      limit_threads(self.torch_threads)
+      models = Models(*load_models())
+    except Exception as e:
+      ready.set_exception(e)
+      return
+
+    ready.set_result(True)
+
+    while True:
+
+      # 2- take a job
+      job = self.jobs.get()
+      if job is None: # shutdown
+        break
+
+      fn, args, future = job
+      if not future.set_running_or_notify_cancel(): # the request was cancelled while waiting
+        continue
+
+      # 3- run and send back
+      try:
+        future.set_result(fn(models, *args))
+      except Exception as e:
+        future.set_exception(e)
+
+  async def run(self, fn, *args):
+    """
+    Queues fn(models, *args) and waits for its result without blocking the event loop
+    """
+    future = Future()
+
+    try:
+      self.jobs.put_nowait((fn, args, future))
+    except queue.Full:
+      raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Server is busy, please try again in a moment")
+
+    return await asyncio.wrap_future(future)
+
+  def ocr_stats(self):
+    # the worker threads share the counters of this process
+    return ocr_tier_stats()
+
+  def release(self, stickers):
+    # the crops are plain arrays in this process, nothing to free
+    pass
+
+  def shutdown(self):
+    for _ in self.threads:
+      self.jobs.put(None)
+
+
+""" PROCESS WORKERS """
+
+# per process state, set by _init_worker
+_models = None
+_ready_barrier = None
+
+def _init_worker(torch_threads, ready_barrier, tier_counts):
+  """
+  Runs once in every worker process
+  1- Limit torch to this worker's share of the cores + count the ocr tiers in the shared counters
+  2- Load the models
+  """
+  global _models, _ready_barrier
+
+  # 1- threads + counters
+  limit_threads(torch_threads)
+  use_shared_tier_counts(tier_counts)
+
+  # 2- models
+  _models = Models(*load_models())
+  _ready_barrier = ready_barrier
+
+def _wait_ready():
+  """
+  Blocks until every worker started (so each one gets exactly one of these)
+  Returns (pid, backend the worker's models really run on)
+  """
+  _ready_barrier.wait()
+  return os.getpid(), loaded_backend()
+
+def _run_job(fn, args):
+  """
+  Runs a job inside a worker process
+  1- SharedImage args (and the SharedImage crops of a stickers list) are read from their shared memory blocks
+  2- The crops found by stickers_job go back through a new shared memory block instead of being pickled
+  """
+  blocks = {}
+
+  def read_shared(handle):
+    if handle.name not in blocks:
+      blocks[handle.name] = shared_memory.SharedMemory(name=handle.name)
+
+    # copy out (the models keep references to their input arrays, the block is closed below)
+    view = np.ndarray(handle.shape, dtype=handle.dtype, buffer=blocks[handle.name].buf, offset=handle.offset)
+    return view.copy()
+
+  # 1- inputs
+  try:
+    real_args = []
+    for arg in args:
+      if isinstance(arg, SharedImage):
+        real_args.append(read_shared(arg))
+
+      elif isinstance(arg, list) and arg and isinstance(arg[0], dict) and isinstance(arg[0].get("crop"), SharedImage):
+        real_args.append([dict(sticker, crop=read_shared(sticker["crop"])) for sticker in arg])
+
+      else:
+        real_args.append(arg)
+
+  finally:
+    for shm in blocks.values():
+      shm.close()
+
+  result = fn(_models, *real_args)
+
+  # 2- crops
+  if fn is stickers_job:
+    return share_stickers(result)
+
+  return result
+
+def share_image(image):
+  """
+  Copies the image array into a new shared memory block
+  """
+  shm = shared_memory.SharedMemory(create=True, size=max(1, image.nbytes))
+  np.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)[...] = image
+
+  return shm, SharedImage(shm.name, image.shape, image.dtype.str)
+
+def share_stickers(stickers):
+  """
+  Copies all the sticker crops of a sheet into one shared memory block, the crops become SharedImage handles
+  the api process only passes the handles on to read_job and unlinks the block after it (release)
+  """
+  if not stickers:
+    return stickers
+
+  crops = [sticker["crop"] for sticker in stickers]
+  shm = shared_memory.SharedMemory(create=True, size=max(1, sum(crop.nbytes for crop in crops)))
+
+  shared = []
+  offset = 0
+  for sticker, crop in zip(stickers, crops):
+    np.ndarray(crop.shape, dtype=crop.dtype, buffer=shm.buf, offset=offset)[...] = crop
+    shared.append(dict(sticker, crop=SharedImage(shm.name, crop.shape, crop.dtype.str, offset)))
+    offset += crop.nbytes
+
+  shm.close()
+  return shared
+
+def unlink_block(name):
+  """
+  Frees a shared memory block by name (no error if it's already gone)
+  """
+  try:
+    shm = shared_memory.SharedMemory(name=name)
+  except FileNotFoundError:
+    return
+
+  shm.close()
+  shm.unlink()
+
+class ProcessInferenceExecutor:
+  """
+  Same as InferenceExecutor but with worker processes
+  every process loads the models once and sets its own torch thread count,
+  image arrays are handed over through shared memory instead of being pickled
+  """
+
+  def __init__(self, workers=INFERENCE_WORKERS, queue_size=INFERENCE_QUEUE_SIZE, torch_threads=INFERENCE_TORCH_THREADS):
+    self.workers = workers
+    self.torch_threads = torch_threads
+    self.capacity = workers + queue_size # running + waiting
+    self.pending = 0
+    self.pool = None
+    self.tier_counts = None
+    self.backend = None # what the models really run on (after the fallbacks), set by start
+
+  async def start(self):
+    """
+    Starts the worker processes and waits until all of them loaded their models
+    """
+    ctx = get_context("spawn") # fork + torch threads = deadlocks
+    ready_barrier = ctx.Barrier(self.workers)
+
+    # [runs, hits] per ocr tier, summed by all the workers (read by ocr_stats without a job)
+    self.tier_counts = ctx.Array("q", len(PREPROCESSORS) * 2)
+
+    self.pool = ProcessPoolExecutor(
+      max_workers=self.workers,
+      mp_context=ctx,
+      initializer=_init_worker,
+      initargs=(self.torch_threads, ready_barrier, self.tier_counts)
+    )
+
+    ready = await asyncio.gather(*[asyncio.wrap_future(self.pool.submit(_wait_ready)) for _ in range(self.workers)])
+    print(f"Inference workers ready: {[pid for pid, _ in ready]}")
+
+    # the models were loaded (and self-checked) in the workers, not here
+    self.backend = " | ".join(sorted({backend for _, backend in ready}))
+
+  async def run(self, fn, *args):
+    """
+    Sends fn(models, *args) to a worker process and waits for its result
+    the shared memory blocks are freed when the job is over, even if the request was cancelled before
+    (the worker may still be reading them)
+    """
+    if self.pending >= self.capacity:
+      raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Server is busy, please try again in a moment")
+
+    self.pending += 1
+    blocks = []
+    future = None
+    cancelled = False
+
+    try:
+      shared_args = []
+      for arg in args:
+        if isinstance(arg, np.ndarray):
+          shm, handle = share_image(arg)
+          blocks.append(shm)
+          shared_args.append(handle)
+
+        else:
+          shared_args.append(arg)
+
+      future = self.pool.submit(_run_job, fn, shared_args)
+      return await asyncio.wrap_future(future) # cancelling this also cancels the job if it didn't start yet
+
+    except asyncio.CancelledError:
+      cancelled = True
+      raise
+
+    finally:
+      self.pending -= 1
+
+      if future is None:
+        free_blocks(blocks)
+      else:
+        future.add_done_callback(partial(self._job_done, blocks, cancelled))
+
+  def _job_done(self, blocks, cancelled, future):
+    """
+    Runs when the worker is done with a job (or it was cancelled before starting)
+    1- Free the input blocks
+    2- Free the crops of a result nobody is waiting for anymore
+    """
+    # 1- inputs
+    free_blocks(blocks)
+
+    # 2- orphan result
+    if cancelled and not future.cancelled() and future.exception() is None:
+      result = future.result()
+      if isinstance(result, list):
+        self.release(result)
+
+  def ocr_stats(self):
+    # all the workers, not only the one a job would land on
+    return shared_tier_stats(self.tier_counts)
+
+  def release(self, stickers):
+    """
+    Frees the shared memory blocks of the sticker crops returned by stickers_job (call it once read_job is done)
+    """
+    names = {sticker["crop"].name for sticker in stickers if isinstance(sticker, dict) and isinstance(sticker.get("crop"), SharedImage)}
+
+    for name in names:
+      unlink_block(name)
+
+  def shutdown(self):
+    if self.pool:
+      self.pool.shutdown(wait=False, cancel_futures=True)
+
+def free_blocks(blocks):
+  for shm in blocks:
+    shm.close()
+    shm.unlink()
+
+async def run_when_free(inference, fn, *args):
+  """
+  Same as inference.run but waits for room in the queue instead of the 503
+  for the background jobs (nobody is waiting on a response, they are there to absorb the load)
+  """
+  delay = QUEUE_RETRY_SECONDS
+
+  while True:
+    try:
+      return await inference.run(fn, *args)
+
+    except HTTPException as e:
+      if e.status_code != status.HTTP_503_SERVICE_UNAVAILABLE:
+        raise
+
+    await asyncio.sleep(delay)
+    delay = min(delay * 2, QUEUE_RETRY_MAX_SECONDS)
+
+def create_executor():
+  """
+  Picks the executor based on INFERENCE_MODE
+  """
+  if INFERENCE_MODE == "process":
+    return ProcessInferenceExecutor()
+
+  return InferenceExecutor()
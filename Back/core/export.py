@@ -0,0 +1,155 @@
+from fastapi import HTTPException, status
+from fastapi.responses import StreamingResponse
+
+from tempfile import SpooledTemporaryFile
+from importlib.util import find_spec
+from typing import Literal
+import hashlib
+import zipfile
+import shutil
+import datetime
+import json
+import csv
+import io
+
+# Modules
+from Back.core.report import excel_structure, save_data, read_chunks, REPORT_SPOOL_BYTES
+
+# "xlsx" is the report with the images inside, the others are text only (the billing side only needs the columns)
+ExportFormat = Literal["xlsx", "ndjson", "csv", "parquet"]
+
+# "none" -> text only, "zip" -> the text file + the sticker thumbnails (named by their "Sticker ID") in one zip
+ImageMode = Literal["none", "zip"]
+
+# parquet is written with polars (in requirements.txt, no pyarrow needed)
+PARQUET_AVAILABLE = find_spec("polars") is not None
+
+MEDIA_TYPES = {
+  "ndjson": "application/x-ndjson",
+  "csv": "text/csv; charset=utf-8",
+  "parquet": "application/vnd.apache.parquet",
+  "zip": "application/zip",
+}
+
+# same columns as the report, the image column is replaced by the id of the sticker
+EXPORT_COLUMNS = [col for col, _ in excel_structure if col != "Sticker image"] + ["Sticker ID"]
+
+def sticker_id(image_bytes):
+  """
+  Content hash of the thumbnail ("" if there is none), same sticker -> same id
+  """
+  if not image_bytes:
+    return ""
+
+  return hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+
+def export_rows(patient_data):
+  """
+  Yields (text row, sticker id, thumbnail bytes) per patient
+  rows that already know their "Sticker ID" (eg. from patient_records) keep it
+  """
+  for row_data in patient_data:
+    image_bytes = row_data.get("image_data")
+    image_id = row_data.get("Sticker ID") or sticker_id(image_bytes)
+
+    row = {col: row_data.get(col, "") for col in EXPORT_COLUMNS[:-1]}
+    row["Sticker ID"] = image_id
+
+    yield row, image_id, image_bytes
+
+def write_ndjson(rows, output):
+  for row in rows:
+    output.write(json.dumps(row, ensure_ascii=False).encode("utf-8") + b"\n")
+
+def write_csv(rows, output):
+  text = io.TextIOWrapper(output, encoding="utf-8", newline="")
+  writer = csv.DictWriter(text, fieldnames=EXPORT_COLUMNS)
+
+  writer.writeheader()
+  writer.writerows(rows)
+
+  text.flush()
+  text.detach() # keep the output open
+
+def write_parquet(rows, output):
+  import polars as pl
+
+  # every column is text (the cleaned ocr values + the sticker id)
+  frame = pl.DataFrame(
+    ({col: str(row[col]) for col in EXPORT_COLUMNS} for row in rows),
+    schema={col: pl.String for col in EXPORT_COLUMNS}
+  )
+
+  frame.write_parquet(output)
+
+WRITERS = {
+  "ndjson": write_ndjson,
+  "csv": write_csv,
+  "parquet": write_parquet,
+}
+
+def check_export(fmt, images):
+  """
+  400 for an export the api can't make (called before any work is done)
+  """
+  if fmt == "parquet" and not PARQUET_AVAILABLE:
+    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Parquet export is not available on this server (polars is not installed)")
+
+def build_export(patient_data, fmt, images="none"):
+  """
+  1- Write the text rows in the format (spooled temp file)
+  2- images="zip" -> put that file and every thumbnail (once per Sticker ID) in a zip
+  Returns (file at position 0, extension)
+  """
+  output = SpooledTemporaryFile(max_size=REPORT_SPOOL_BYTES)
+
+  try:
+    # 1- text only
+    if images == "none":
+      WRITERS[fmt]((row for row, _, _ in export_rows(patient_data)), output)
+      output.seek(0)
+      return output, fmt
+
+    # 2- text + stickers, every thumbnail goes in the zip as soon as its row is read (once per Sticker ID)
+    # the text file is spooled next to the zip and added last (a zip only has one entry open for writing)
+    seen = set()
+
+    with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED) as archive, SpooledTemporaryFile(max_size=REPORT_SPOOL_BYTES) as data_file:
+
+      def text_rows():
+        for row, image_id, image_bytes in export_rows(patient_data):
+          if image_id and image_bytes and image_id not in seen:
+            seen.add(image_id)
+            # the pngs are already compressed
+            archive.writestr(f"stickers/{image_id}.png", image_bytes, compress_type=zipfile.ZIP_STORED)
+
+          yield row
+
+      WRITERS[fmt](text_rows(), data_file)
+
+      data_file.seek(0)
+      with archive.open(f"patients.{fmt}", "w") as entry:
+        shutil.copyfileobj(data_file, entry, 1024 * 1024)
+
+    output.seek(0)
+    return output, "zip"
+
+  except BaseException:
+    output.close()
+    raise
+
+def export_response(patient_data, fmt="xlsx", images="none"):
+  """
+  Sends the patients in the requested format as a download (xlsx -> the usual report)
+  """
+  if fmt == "xlsx":
+    return save_data(patient_data)
+
+  output, extension = build_export(patient_data, fmt, images)
+
+  filename_str = datetime.datetime.now().strftime(f"Patients_%Y-%m-%d_%H-%M.{extension}")
+  return StreamingResponse(
+    read_chunks(output),
+    media_type=MEDIA_TYPES[extension],
+    headers={"Content-Disposition": f"attachment; filename={filename_str}"}
+  )
\ No newline at end of file
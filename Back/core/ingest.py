@@ -0,0 +1,272 @@
+from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+
+from contextlib import aclosing
+from functools import partial
+import asyncio
+import os
+
+# Modules
+from Back.core.decode import decode_image
+from Back.core.pipeline import SURGEON_BATCH_ACROSS_SHEETS
+from Back.core.executor import sheet_job, stickers_job, read_job, run_when_free
+from Back.services.result_cache import image_key
+
+ALLOWED_TYPES = ["image/jpeg", "image/png", "image/jpg", "image/dng", "image/heic", "image/heif"]
+
+# how many images are read + decoded ahead while the current one is in the models (0 -> one after the other)
+# every prefetched image is one more decoded sheet in memory
+DECODE_PREFETCH = int(os.getenv("DECODE_PREFETCH", 1))
+
+def is_allowed(filename, content_type):
+  return content_type in ALLOWED_TYPES or filename.lower().endswith(('.heic', '.heif'))
+
+async def iterate(images):
+  """
+  Same loop for a list of uploads and for stream_uploads (async)
+  """
+  if hasattr(images, "__aiter__"):
+    async for image in images:
+      yield image
+  else:
+    for image in images:
+      yield image
+
+async def read_and_decode(image):
+  """
+  Reads the upload, closes it and decodes it (the compressed bytes are released when this returns)
+  """
+  try:
+    contents = await image.read()
+  finally:
+    await image.close()
+
+  return await run_in_threadpool(decode_image, contents, image.filename, image.content_type)
+
+async def decode_entry(image):
+  """
+  Checks the type, reads and decodes one upload -> (image, image_array, state)
+  state is None when the image is ready, else "skipped" / "failed" (image_array is None)
+  """
+  # 1- check type
+  if not is_allowed(image.filename, image.content_type):
+    # skip instead of crashing everything
+    print(f"Skipping {image.filename}: Invalid type {image.content_type}")
+    await image.close()
+    return image, None, "skipped"
+
+  # 2- read and decode
+  try:
+    return image, await read_and_decode(image), None
+
+  except Exception as e:
+    print(f"Failed to decode image {image.filename}, Error: {e}")
+    return image, None, "failed"
+
+async def decoded_images(images, depth=DECODE_PREFETCH):
+  """
+  Yields decode_entry(image) for every upload, in order
+  depth > 0 -> a background task reads and decodes the next images (threadpool) while the caller runs the current one,
+  at most depth images are decoded ahead of the one being processed
+  errors of the upload stream itself (413, 422...) are raised here, in the caller's task
+  """
+  if depth <= 0:
+    async for image in iterate(images):
+      yield await decode_entry(image)
+    return
+
+  slots = asyncio.Semaphore(depth + 1) # the image being processed + depth ahead
+  queue = asyncio.Queue()
+  end = object()
+
+  async def prefetch():
+    try:
+      async for image in iterate(images):
+        await slots.acquire()
+        await queue.put(await decode_entry(image))
+
+      await queue.put(end)
+
+    except Exception as e:
+      await queue.put(e)
+
+  task = asyncio.create_task(prefetch())
+
+  try:
+    while True:
+      entry = await queue.get()
+
+      if entry is end:
+        break
+      if isinstance(entry, Exception):
+        raise entry
+
+      yield entry
+
+      # the caller is done with this image
+      entry = None
+      slots.release()
+
+  finally:
+    task.cancel()
+
+    # uploads that were decoded ahead but never processed
+    while not queue.empty():
+      entry = queue.get_nowait()
+      if isinstance(entry, tuple):
+        await entry[0].close()
+
+async def read_sheets(run, all_stickers, pending_sheets, progress):
+  """
+  Surgeon + OCR of the stickers of all the sheets (SURGEON_BATCH_ACROSS_SHEETS)
+  1- One read_job for all of them, split back per sheet
+  2- If it fails, every sheet is read on its own so only the failing sheet is lost (same as the per sheet path)
+  Returns the rows of every sheet (None for a failed one), in pending_sheets order
+  """
+  def split(rows):
+    results, start = [], 0
+    for _, _, _, count in pending_sheets:
+      results.append(rows[start:start + count])
+      start += count
+    return results
+
+  # 1- one batch
+  try:
+    return split(await run(read_job, all_stickers))
+
+  except HTTPException as e:
+    if e.status_code == status.HTTP_503_SERVICE_UNAVAILABLE: # inference queue is full
+      raise
+    print(f"Error while reading the stickers of all sheets, reading them sheet by sheet: {e}")
+
+  except Exception as e:
+    print(f"Error while reading the stickers of all sheets, reading them sheet by sheet: {e}")
+
+  # 2- one sheet at a time
+  results = []
+  for (index, filename, _, _), stickers in zip(pending_sheets, split(all_stickers)):
+    try:
+      results.append(await run(read_job, stickers) if stickers else [])
+
+    except HTTPException as e:
+      if e.status_code == status.HTTP_503_SERVICE_UNAVAILABLE:
+        raise
+      print(f"Error while reading the stickers of {filename}: {e}")
+      await progress(index, "failed")
+      results.append(None)
+
+    except Exception as e:
+      print(f"Error while reading the stickers of {filename}: {e}")
+      await progress(index, "failed")
+      results.append(None)
+
+  return results
+
+async def process_images(images, inference, on_progress=None, batcher=None, cache=None, wait_for_workers=False):
+  """
+  Runs the whole pipeline on the uploaded images (used by /upload and /jobs)
+  1- Check if image is allowed
+  2- Read and decode (threadpool, up to DECODE_PREFETCH images ahead of the inference)
+  3- Find stickers + read fields (inference workers)
+  4- Return all the patients of all the images
+
+  images -> list of uploads or the stream_uploads generator, each image is released as soon as it's processed
+  on_progress(index, state, patients) is awaited every time an image changes state
+  batcher -> the hunter runs in a batch shared with other requests' sheets
+  cache -> sheets that were already processed (same pixels + same models) skip the inference
+  wait_for_workers -> a full inference queue is waited out instead of the 503 (background jobs)
+  """
+  run = partial(run_when_free, inference) if wait_for_workers else inference.run
+
+  async def progress(index, state, patients=0):
+    if on_progress:
+      await on_progress(index, state, patients)
+
+  all_patient_data = []
+  all_stickers = [] # only used when the surgeon batch is shared between sheets
+  pending_sheets = [] # (index, filename, cache key, number of stickers) of every sheet in all_stickers
+
+  try:
+    index = -1
+    # closed right away if the loop stops early (503), so the prefetch doesn't keep decoding
+    async with aclosing(decoded_images(images)) as entries:
+      async for image, image_array, state in entries:
+        index += 1
+
+        # 1- 2- skipped / failed to decode
+        if state:
+          await progress(index, state)
+          continue
+
+        await progress(index, "processing")
+
+        # 3- process the image array
+        try:
+          key = None
+          if cache:
+            key = await run_in_threadpool(image_key, image_array, inference.backend)
+            cached_result = await cache.get(key, image.filename)
+
+            if cached_result is not None:
+              all_patient_data.extend(cached_result)
+              await progress(index, "done", len(cached_result))
+              continue
+
+          boxes = None
+          if batcher:
+            try:
+              boxes = await batcher.detect(image_array)
+
+            except HTTPException as e:
+              # a job doesn't give up on a full queue, the hunter runs in the sheet's own job below
+              if not (wait_for_workers and e.status_code == status.HTTP_503_SERVICE_UNAVAILABLE):
+                raise
+
+          if SURGEON_BATCH_ACROSS_SHEETS:
+            # only find the stickers now, the surgeon + ocr run once for all sheets below
+            stickers = await run(stickers_job, image_array, image.filename, boxes)
+            all_stickers.extend(stickers)
+            pending_sheets.append((index, image.filename, key, len(stickers)))
+            await progress(index, "done", len(stickers))
+            continue
+
+          sheet_result = await run(sheet_job, image_array, image.filename, boxes)
+
+          all_patient_data.extend(sheet_result)
+          await progress(index, "done", len(sheet_result))
+
+          if cache:
+            await cache.put(key, sheet_result)
+
+        except HTTPException as e:
+          if e.status_code == status.HTTP_503_SERVICE_UNAVAILABLE: # inference queue is full
+            raise
+
+          print(f"Error while processing {image.filename}: {e}")
+          await progress(index, "failed")
+          continue
+
+        except Exception as e:
+          print(f"Error while processing {image.filename}: {e}")
+          await progress(index, "failed")
+          continue
+
+        finally:
+          image_array = None # released before the next image is received
+
+    if all_stickers:
+      sheet_results = await read_sheets(run, all_stickers, pending_sheets, progress)
+
+      for (_, _, key, _), sheet_result in zip(pending_sheets, sheet_results):
+        if sheet_result is None: # this sheet failed
+          continue
+
+        all_patient_data.extend(sheet_result)
+        if cache:
+          await cache.put(key, sheet_result)
+
+  finally:
+    # process mode: the crops wait in shared memory until read_job is done
+    inference.release(all_stickers)
+
+  return all_patient_data
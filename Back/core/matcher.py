@@ -0,0 +1,104 @@
+from difflib import SequenceMatcher
+from collections import defaultdict
+from functools import lru_cache
+import json
+import os
+import re
+
+PAYMENTS_PATH = os.path.join(os.path.dirname(__file__), "payments.json")
+
+# number of different ocr strings remembered by the matcher
+PAYMENT_CACHE_SIZE = int(os.getenv("PAYMENT_CACHE_SIZE", 4096))
+
+# hamza / taa marbuta / alef maqsura folding + tatweel removal
+ARABIC_FOLDS = str.maketrans({
+  "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+  "ؤ": "و", "ئ": "ي", "ى": "ي",
+  "ة": "ه",
+  "ـ": None,
+})
+TASHKEEL = re.compile(r"[\u064B-\u0652\u0670]") # harakat + superscript alef
+
+def normalize(text):
+  """
+  Lowercase + arabic folding + single spaces, so "التأمين" and "التامين" are the same word
+  """
+  text = TASHKEEL.sub("", text.lower()).translate(ARABIC_FOLDS)
+  return " ".join(text.split())
+
+def trigrams(text):
+  padded = f"  {text} "
+  return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class PaymentMatcher:
+  """
+  Maps an OCR'd payment field to its canonical value, built once from payments.json
+  1- Every alias is normalized and put in a trigram index
+  2- Aliases are checked in file order (first match wins):
+     keyword substring first, then the similarity, but only for aliases that share a trigram with the text
+  3- Results are memoized (the same strings come back all the time)
+  """
+
+  def __init__(self, payments, cache_size=PAYMENT_CACHE_SIZE):
+    self.rules = [] # (canonical name, normalized alias, threshold, normalized keywords)
+    self.index = defaultdict(set) # trigram -> rule ids
+    self.misread_keywords = [] # keywords of the payments that get misread as names
+
+    for payment in payments:
+      for alias in payment["aliases"]:
+        rule_id = len(self.rules)
+        alias_text = normalize(alias["text"])
+        keywords = [normalize(k) for k in alias["keywords"]]
+
+        self.rules.append((payment["name"], alias_text, alias["threshold"], keywords))
+
+        for gram in trigrams(alias_text):
+          self.index[gram].add(rule_id)
+
+        if payment.get("name_misread"):
+          self.misread_keywords.extend(keywords)
+
+    self.match = lru_cache(maxsize=cache_size)(self._match)
+    self.is_name_misread = lru_cache(maxsize=cache_size)(self._is_name_misread)
+
+  def candidates(self, text):
+    """
+    Rule ids of the aliases that share at least one trigram with the text
+    """
+    ids = set()
+    for gram in trigrams(text):
+      ids |= self.index.get(gram, set())
+
+    return ids
+
+  def _match(self, text):
+    """
+    Returns the canonical payment name, or None if nothing matches
+    """
+    text = normalize(text)
+    candidates = self.candidates(text)
+
+    for rule_id, (name, alias, threshold, keywords) in enumerate(self.rules):
+
+      # strict substring match (fast)
+      if any(k in text for k in keywords):
+        return name
+
+      # similarity checking (slower), the quick ratios are upper bounds of ratio()
+      if rule_id in candidates:
+        seq = SequenceMatcher(None, text, alias)
+        if seq.real_quick_ratio() > threshold and seq.quick_ratio() > threshold and seq.ratio() > threshold:
+          return name
+
+    return None
+
+  def _is_name_misread(self, text):
+    """
+    True if the text is an insurer the OCR reads in the name field (eg "nathealth")
+    """
+    text = normalize(text)
+    return any(k in text for k in self.misread_keywords)
+
+def load_payment_matcher(path=PAYMENTS_PATH):
+  with open(path, encoding="utf-8") as f:
+    return PaymentMatcher(json.load(f)["payments"])
@@ -0,0 +1,356 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from tempfile import SpooledTemporaryFile, TemporaryDirectory, mkstemp
+from xml.etree import ElementTree as ET
+from itertools import repeat
+from PIL import Image
+import posixpath
+import xlsxwriter
+import hashlib
+import zipfile
+import openpyxl
+import pickle
+import os
+
+# Modules
+from Back.core.report import REPORT_SPOOL_BYTES
+
+# processes parsing the uploaded reports in parallel, 0 -> parsed one by one in the request thread
+MERGE_WORKERS = int(os.getenv("MERGE_WORKERS", min(4, os.cpu_count() or 1)))
+
+# xml namespaces of the xlsx parts
+MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+XDR_NS = "http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing"
+A_NS = "http://schemas.openxmlformats.org/drawingml/2006/main"
+
+EMU_PER_PIXEL = 9525
+
+# columns kept from a <col min max> range (the last one often spans to column XFD)
+MAX_COLUMNS = 256
+
+# rows pickled together in the parsed rows file
+ROWS_CHUNK = 1000
+
+
+""" PACKAGE HELPERS """
+
+def resolve(part, target):
+  """
+  Path of a relationship target inside the zip (targets are relative to the part's folder)
+  """
+  if target.startswith("/"):
+    return target.lstrip("/")
+
+  return posixpath.normpath(posixpath.join(posixpath.dirname(part), target))
+
+def read_rels(archive, part):
+  """
+  {relationship id: target part} of a part ({} if it has none)
+  """
+  folder, name = posixpath.split(part)
+  rels_part = posixpath.join(folder, "_rels", name + ".rels")
+
+  try:
+    root = ET.fromstring(archive.read(rels_part))
+  except KeyError: # no relationships
+    return {}
+
+  return {
+    rel.get("Id"): resolve(part, rel.get("Target"))
+    for rel in root.iter(f"{{{PKG_REL_NS}}}Relationship")
+    if rel.get("TargetMode") != "External"
+  }
+
+def active_sheet(archive):
+  """
+  (title, part) of the sheet that opens first, same one as openpyxl's wb.active
+  """
+  workbook_part = "xl/workbook.xml"
+  root = ET.fromstring(archive.read(workbook_part))
+
+  view = root.find(f"{{{MAIN_NS}}}bookViews/{{{MAIN_NS}}}workbookView")
+  active = int(view.get("activeTab", 0)) if view is not None else 0
+
+  sheets = root.findall(f"{{{MAIN_NS}}}sheets/{{{MAIN_NS}}}sheet")
+  sheet = sheets[min(active, len(sheets) - 1)]
+
+  return sheet.get("name"), read_rels(archive, workbook_part)[sheet.get(f"{{{REL_NS}}}id")]
+
+def sheet_layout(archive, sheet_part):
+  """
+  One streaming pass over the sheet xml for what openpyxl's read only mode doesn't give
+  Returns ({column: width}, {row: height}, drawing relationship id), 0 based
+  """
+  widths, heights, drawing_id = {}, {}, None
+
+  for _, elem in ET.iterparse(archive.open(sheet_part)):
+    tag = elem.tag
+
+    if tag == f"{{{MAIN_NS}}}col" and elem.get("width"):
+      first = int(elem.get("min")) - 1
+      for col in range(first, min(int(elem.get("max")), first + MAX_COLUMNS)):
+        widths[col] = float(elem.get("width"))
+
+    elif tag == f"{{{MAIN_NS}}}row":
+      if elem.get("ht"):
+        heights[int(elem.get("r")) - 1] = float(elem.get("ht"))
+      elem.clear() # the cells are read by openpyxl
+
+    elif tag == f"{{{MAIN_NS}}}drawing":
+      drawing_id = elem.get(f"{{{REL_NS}}}id")
+
+  return widths, heights, drawing_id
+
+def extract_media(archive, media_part, media_dir):
+  """
+  Copies an image out of the zip as it is (no decoding), named by its content hash
+  so the same sticker in many reports is only stored once
+  """
+  data = archive.read(media_part)
+  extension = posixpath.splitext(media_part)[1].lower()
+
+  path = os.path.join(media_dir, hashlib.blake2b(data, digest_size=16).hexdigest() + extension)
+  if not os.path.exists(path):
+    # the workers share media_dir, the temp file -> final name in one step so nobody reads half an image
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+      f.write(data)
+
+    os.replace(tmp, path)
+
+  return path
+
+def image_scale(path, ext):
+  """
+  xlsxwriter scale that gives the image the size it had in the source report
+  (xlsxwriter sizes an image from its pixels and its dpi)
+  """
+  if ext is None:
+    return 1.0, 1.0
+
+  with Image.open(path) as img: # only reads the header
+    width, height = img.size
+    x_dpi, y_dpi = img.info.get("dpi", (96, 96))
+
+  x_dpi, y_dpi = x_dpi or 96, y_dpi or 96
+  target_width, target_height = int(ext.get("cx")) / EMU_PER_PIXEL, int(ext.get("cy")) / EMU_PER_PIXEL
+
+  return target_width * x_dpi / (96 * width), target_height * y_dpi / (96 * height)
+
+def sheet_images(archive, sheet_part, drawing_id, media_dir):
+  """
+  Images of the sheet's drawing -> list of (row, col, x_offset, y_offset, path, x_scale, y_scale), 0 based
+  """
+  if drawing_id is None:
+    return []
+
+  drawing_part = read_rels(archive, sheet_part)[drawing_id]
+  drawing_rels = read_rels(archive, drawing_part)
+  root = ET.fromstring(archive.read(drawing_part))
+
+  media_paths = {}
+  images = []
+
+  for anchor in root:
+    kind = anchor.tag.split("}")[-1]
+    blip = anchor.find(f".//{{{A_NS}}}blip")
+
+    # absolute anchors (not tied to a row) and shapes / charts are not copied
+    if kind not in ("twoCellAnchor", "oneCellAnchor") or blip is None:
+      continue
+
+    start = anchor.find(f"{{{XDR_NS}}}from")
+    row = int(start.findtext(f"{{{XDR_NS}}}row"))
+    col = int(start.findtext(f"{{{XDR_NS}}}col"))
+    x_offset = int(start.findtext(f"{{{XDR_NS}}}colOff")) / EMU_PER_PIXEL
+    y_offset = int(start.findtext(f"{{{XDR_NS}}}rowOff")) / EMU_PER_PIXEL
+
+    # size of the image in the source
+    if kind == "oneCellAnchor":
+      ext = anchor.find(f"{{{XDR_NS}}}ext")
+    else:
+      ext = anchor.find(f".//{{{A_NS}}}xfrm/{{{A_NS}}}ext")
+
+    media_part = drawing_rels[blip.get(f"{{{REL_NS}}}embed")]
+    if media_part not in media_paths:
+      media_paths[media_part] = extract_media(archive, media_part, media_dir)
+
+    path = media_paths[media_part]
+    images.append((row, col, x_offset, y_offset, path, *image_scale(path, ext)))
+
+  return images
+
+
+""" PARSE (runs in the merge workers) """
+
+def spool_rows(values, heights, rows_dir):
+  """
+  Writes the data rows to a temp file in rows_dir, ROWS_CHUNK (values, height) per pickle
+  so a report is never held in memory (or sent back from the worker) as one list
+  Returns (path, number of rows)
+  """
+  fd, rows_path = mkstemp(suffix=".rows", dir=rows_dir)
+  count = 0
+
+  with os.fdopen(fd, "wb") as f:
+    chunk = []
+
+    for index, row in enumerate(values, 1):
+      chunk.append((row, heights.get(index)))
+
+      if len(chunk) == ROWS_CHUNK:
+        pickle.dump(chunk, f)
+        count += len(chunk)
+        chunk = []
+
+    if chunk:
+      pickle.dump(chunk, f)
+      count += len(chunk)
+
+  return rows_path, count
+
+def read_rows(rows_path):
+  """
+  Yields the (values, height) of a spool_rows file, then deletes it
+  """
+  try:
+    with open(rows_path, "rb") as f:
+      while True:
+        try:
+          chunk = pickle.load(f)
+        except EOFError:
+          return
+
+        yield from chunk
+
+  finally:
+    os.remove(rows_path)
+
+def parse_report(path, media_dir, rows_dir):
+  """
+  Reads one uploaded report without loading it as a full workbook
+  1- Cell values with openpyxl's read only mode (streamed into a rows file in rows_dir)
+  2- Column widths + row heights from one pass over the sheet xml
+  3- Images straight from the zip (raw bytes written to media_dir)
+  Returns {"header", "widths", "rows": rows file, "row_count", "images"}
+  """
+  with zipfile.ZipFile(path) as archive:
+    title, sheet_part = active_sheet(archive)
+
+    # 2- layout
+    widths, heights, drawing_id = sheet_layout(archive, sheet_part)
+
+    # 3- images
+    images = sheet_images(archive, sheet_part, drawing_id, media_dir)
+
+  # 1- values
+  workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+  try:
+    values = workbook[title].iter_rows(values_only=True)
+    header = next(values, ())
+    rows_path, row_count = spool_rows(values, heights, rows_dir)
+
+  finally:
+    workbook.close()
+
+  return {"header": header, "widths": widths, "rows": rows_path, "row_count": row_count, "images": images}
+
+
+""" WRITE """
+
+def write_merged(reports, output, tmpdir):
+  """
+  Writes the parsed reports one after the other with xlsxwriter's constant_memory mode
+  1- Header + column widths from the first report
+  2- Data rows (without their header) + their heights
+  3- Images moved down by the number of rows written before them
+  Returns the number of data rows
+  """
+  workbook = xlsxwriter.Workbook(output, {"constant_memory": True, "tmpdir": tmpdir, "default_date_format": "yyyy-mm-dd"})
+  worksheet = workbook.add_worksheet("Merged_Patients")
+  worksheet.right_to_left() # right to left sheet
+
+  header_format = workbook.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+
+  current_row_offset = 0 # data rows already written (row 0 is the header)
+  headers_set = False
+
+  for report in reports:
+
+    # 1- headers only from the first file
+    if not headers_set:
+      for col, width in report["widths"].items():
+        worksheet.set_column(col, col, max(0, width - 5 / 7)) # xlsxwriter adds the cell padding back
+
+      worksheet.write_row(0, 0, report["header"], header_format)
+      headers_set = True
+
+    # 2- data rows
+    for row_index, (values, height) in enumerate(read_rows(report["rows"]), 1):
+      target_row_index = current_row_offset + row_index
+
+      if height:
+        worksheet.set_row(target_row_index, height) # before the row is written (constant_memory)
+
+      worksheet.write_row(target_row_index, 0, values)
+
+    # 3- images (only the ones in the data range, not the header)
+    for row, col, x_offset, y_offset, path, x_scale, y_scale in report["images"]:
+      if row < 1:
+        continue
+
+      worksheet.insert_image(current_row_offset + row, col, path, {
+        "x_offset": x_offset,
+        "y_offset": y_offset,
+        "x_scale": x_scale,
+        "y_scale": y_scale,
+        "object_position": 1
+      })
+
+    # update the offset for the next file
+    current_row_offset += report["row_count"]
+
+  workbook.close()
+  return current_row_offset
+
+def merge_reports(paths, pool=None):
+  """
+  Merges the reports (xlsx paths, in order) into one workbook in a spooled temp file
+  pool -> parses the files in parallel, the results are written in the upload order
+  Returns the file, at position 0
+  """
+  output = SpooledTemporaryFile(max_size=REPORT_SPOOL_BYTES)
+
+  try:
+    with TemporaryDirectory(prefix="merge_") as tmpdir:
+      media_dir = os.path.join(tmpdir, "media")
+      rows_dir = os.path.join(tmpdir, "rows")
+      os.mkdir(media_dir)
+      os.mkdir(rows_dir)
+
+      if pool and len(paths) > 1:
+        reports = pool.map(parse_report, paths, repeat(media_dir), repeat(rows_dir))
+      else:
+        reports = (parse_report(path, media_dir, rows_dir) for path in paths)
+
+      # the media files have to exist until the workbook is closed
+      write_merged(reports, output, tmpdir)
+
+  except BaseException:
+    output.close()
+    raise
+
+  output.seek(0)
+  return output
+
+def create_merge_pool(workers=MERGE_WORKERS):
+  """
+  Process pool for parse_report (None if turned off), the workers are only started on the first merge
+  spawn -> the workers don't inherit the api's models / torch threads
+  """
+  if workers <= 0:
+    return None
+
+  return ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"))
\ No newline at end of file
@@ -1,9 +1,35 @@
+from easyocr.recognition import get_text
+from easyocr.utils import get_image_list
+from bidi import get_display
+
 from difflib import SequenceMatcher
+from collections import Counter
+import threading
 import datetime
 import cv2
+import os
 import re
 
+# Modules
+from Back.core.matcher import load_payment_matcher
+
+# below this the field is left empty ("-"), and the next preprocessing tier is tried
+OCR_CONFIDENCE_THRESHOLD = 0.3
+
+# preprocessing tiers tried in order (cheap -> expensive) until the confidence is over OCR_CONFIDENCE_THRESHOLD
+# "upscaled" alone -> the old behaviour (every crop upscaled 2x + fixed threshold)
+OCR_TIERS = [tier.strip() for tier in os.getenv("OCR_TIERS", "native,upscaled,adaptive").split(",") if tier.strip()]
+
+# built once at startup
+payment_matcher = load_payment_matcher()
+
 # helper functions
+def preprocess_native(img):
+  """
+  Cheapest tier, grayscale only (the recognizer resizes the crop to its own height anyway)
+  """
+  return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
 def preprocess_image(img):
   """
    Makes text pop out for better OCR.
@@ -23,6 +49,86 @@ def preprocess_image(img):
 
   return thresh
 
+def preprocess_adaptive(img):
+  """
+  Last tier, for shadows / uneven light where the fixed threshold eats the text
+  1- Grayscale + upscale (same as preprocess_image)
+  2- Threshold against the local mean instead of 120
+  """
+  gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+  scaled = cv2.resize(gray, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+
+  return cv2.adaptiveThreshold(scaled, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 15)
+
+PREPROCESSORS = {
+  "native": preprocess_native,
+  "upscaled": preprocess_image,
+  "adaptive": preprocess_adaptive,
+}
+
+for tier in OCR_TIERS:
+  if tier not in PREPROCESSORS:
+    raise ValueError(f"Unknown OCR tier {tier!r} in OCR_TIERS (expected {', '.join(PREPROCESSORS)})")
+
+# how many crops each tier ran on / ended on (since this worker started)
+tier_runs = Counter()
+tier_hits = Counter()
+tier_lock = threading.Lock()
+
+# process mode: [runs, hits] of every tier (PREPROCESSORS order) summed over all the inference workers
+# a multiprocessing Array set by use_shared_tier_counts, the api process reads it without sending a job
+shared_tier_counts = None
+TIER_INDEX = {tier: i for i, tier in enumerate(PREPROCESSORS)}
+
+def use_shared_tier_counts(counts):
+  global shared_tier_counts
+  shared_tier_counts = counts
+
+def count_tier(tier, runs, hits):
+  with tier_lock:
+    tier_runs[tier] += runs
+    tier_hits[tier] += hits
+
+  if shared_tier_counts is not None:
+    index = TIER_INDEX[tier] * 2
+    with shared_tier_counts.get_lock():
+      shared_tier_counts[index] += runs
+      shared_tier_counts[index + 1] += hits
+
+def tier_stats(runs, hits):
+  """
+  Per tier: crops it ran on, crops whose final result came from it, and the share of all crops for both
+  """
+  total = sum(hits.values())
+
+  return {
+    tier: {
+      "runs": runs[tier],
+      "hits": hits[tier],
+      "run_rate": runs[tier] / total if total else 0.0,
+      "hit_rate": hits[tier] / total if total else 0.0,
+    }
+    for tier in OCR_TIERS
+  }
+
+def ocr_tier_stats():
+  """
+  Tier stats of this process (all the worker threads in thread mode)
+  """
+  with tier_lock:
+    return tier_stats(tier_runs, tier_hits)
+
+def shared_tier_stats(counts):
+  """
+  Tier stats of all the worker processes, from the shared counters
+  """
+  with counts.get_lock():
+    values = list(counts)
+
+  runs = {tier: values[i * 2] for tier, i in TIER_INDEX.items()}
+  hits = {tier: values[i * 2 + 1] for tier, i in TIER_INDEX.items()}
+  return tier_stats(runs, hits)
+
 def clean_text(text):
   """
   Cleans up OCR mess from whitespaces + fixes typos in date
@@ -107,61 +213,26 @@ def similar(a, b):
 
 
 def clean_payment(text):
-
+  """
+  Maps the payment field to its canonical value (see payments.json), or keeps the text
+  """
   if not text: return "-"
-  text_clean = text.strip()
-  text_lower = text.lower()
 
-  # Format: (Return value, Target for similarity, Similarity threshold, [List of Keywords])
-  PAYMENT_RULES = [
-    # 1- Nathealth
-    ("Nathealth", "nathealth", 0.8, ["nat", "nathealth"]),
+  return payment_matcher.match(text) or text # default fallback
 
-    # 2- Cash (Personal/Self)
-    ("Cash", "شخصي", 0.7, ["شخص", "self"]),
-    ("Cash", "نقدي", 0.7, ["نقد"]),
-
-    # 3- Military insurance
-    ("الخدمات العسكرية", "الخدمات الطبية العسكرية الفلسطينية", 0.6, ["الفلسطينية"]),
-
-    # 4- MOH (Ministry of Health)
-    ("التأمين الصحي", "وزارة الصحة", 0.6, ["وزارة", "الصحة"]),
-    ("التأمين الصحي", "التامين الصحي", 0.8, ["التأمين"]),
-  ]
-
-  for return_val, target_sim, threshold, keywords in PAYMENT_RULES:
-
-    # strict substring match (fast)
-    if any(k in text_lower for k in keywords):
-      return return_val
-
-    # similarity checking (slower)
-    if similar(text_clean, target_sim) > threshold:
-      return return_val
-
-  return text # default fallback
-
-def get_best_ocr(reader, crop_img):
+def merge_results(results):
   """
-  1- Process images (grays + upscales)
-  2- Read text from processed image
-  3- Detect the scanned language to switch between "LTR" and "RTL"
-  4- Return the scanned text with confidence level
+  Joins easyocr results (box, text, confidence) into one string
+  1- Detect the scanned language to switch between "LTR" and "RTL"
+  2- Return the joined text with the average confidence level
   """
-  # 1- process the image
-  processed_img = preprocess_image(crop_img)
-
-  # 2- read text
-  # detail=1 gives boxes+text+conf
-  results = reader.readtext(processed_img, detail=1)
-
   if not results:
     return "-", 0.0
 
-  # 3- detect language and sort
+  # 1- detect language and sort
   # note: easyocr usually scans Top->Bottom, Left->Right
 
-  # 3.1- check if the scanned text is arabic to make it read Right->Left
+  # 1.1- check if the scanned text is arabic to make it read Right->Left
   is_arabic = False
   for (_, text, _) in results:
     if any('\u0600' <= char <= '\u06FF' for char in text):
@@ -182,4 +253,118 @@ def get_best_ocr(reader, crop_img):
 
   avg_confidence = total_confidence / len(results)
 
-  return " ".join(full_text), avg_confidence
\ No newline at end of file
+  return " ".join(full_text), avg_confidence
+
+def read_crop(reader, crop_img, preprocess=preprocess_image):
+  """
+  1- Process image (see PREPROCESSORS)
+  2- Read text from processed image
+  3- Merge the results (language order + confidence)
+  """
+  # 1- process the image
+  processed_img = preprocess(crop_img)
+
+  # 2- read text
+  # detail=1 gives boxes+text+conf
+  results = reader.readtext(processed_img, detail=1)
+
+  # 3- merge
+  return merge_results(results)
+
+def get_best_ocr(reader, crop_img, tiers=OCR_TIERS):
+  """
+  Reads the crop with the cheapest tier first and only escalates when the confidence is too low
+  returns the most confident (text, confidence) of the tiers that ran
+  """
+  best = ("-", 0.0)
+  ended_on = tiers[-1]
+
+  for tier in tiers:
+    result = read_crop(reader, crop_img, PREPROCESSORS[tier])
+    count_tier(tier, 1, 0)
+
+    if result[1] > best[1]:
+      best = result
+
+    if result[1] >= OCR_CONFIDENCE_THRESHOLD:
+      ended_on = tier
+      break
+
+  count_tier(ended_on, 0, 1)
+  return best
+
+def recognize_crops(reader, crop_imgs, preprocess=preprocess_image, batch_size=16):
+  """
+  Detector free version of read_crop for many crops at once
+  the surgeon model already located the fields, so the CRAFT detector of readtext is skipped
+  1- Process every crop and resize it to the recognizer height (one line per crop)
+  2- Run the recognizer once over all of them, batch_size crops per forward pass
+  3- Return (text, confidence) per crop, in the same order as the crops
+
+  note: reader.recognize goes box by box on cpu, so easyocr's get_text is called directly to batch on cpu too
+  """
+  # 1- process + resize (get_image_list drops a crop it can't resize, those stay "-")
+  image_list = [] # format: (box, resized crop)
+  indices = [] # image_list position -> crop index
+  max_width = reader.imgH
+
+  for i, crop in enumerate(crop_imgs):
+    if crop is None or not crop.size:
+      continue
+
+    img = preprocess(crop)
+    h, w = img.shape[:2]
+
+    resized, width = get_image_list([[0, w, 0, h]], [], img, model_height=reader.imgH)
+    if resized:
+      image_list.extend(resized)
+      indices.append(i)
+      max_width = max(max_width, width)
+
+  results = [("-", 0.0)] * len(crop_imgs)
+  if not image_list:
+    return results
+
+  # 2- recognizer only, same defaults as reader.recognize (greedy decoder, contrast retry under 0.1)
+  ignore_char = "".join(set(reader.character) - set(reader.lang_char))
+  lines = get_text(reader.character, reader.imgH, int(max_width), reader.recognizer, reader.converter, image_list,
+                   ignore_char, "greedy", 5, batch_size, 0.1, 0.5, 0.003, 0, reader.device)
+
+  # 3- one line per crop, in image_list order
+  for i, (box, text, confidence) in zip(indices, lines):
+    if reader.model_lang == "arabic":
+      text = get_display(text)
+
+    results[i] = merge_results([(box, text, confidence)])
+
+  return results
+
+def get_batch_ocr(reader, crop_imgs, batch_size=16, tiers=OCR_TIERS):
+  """
+  Batched get_best_ocr, each tier is one recognizer batch over the crops still under the threshold
+  """
+  best = [("-", 0.0)] * len(crop_imgs)
+  pending = [i for i, crop in enumerate(crop_imgs) if crop is not None and crop.size]
+
+  for tier in tiers:
+    if not pending:
+      break
+
+    results = recognize_crops(reader, [crop_imgs[i] for i in pending], PREPROCESSORS[tier], batch_size)
+    count_tier(tier, len(pending), 0)
+
+    still_pending = []
+    for i, result in zip(pending, results):
+      if result[1] > best[i][1]:
+        best[i] = result
+
+      if result[1] >= OCR_CONFIDENCE_THRESHOLD:
+        count_tier(tier, 0, 1)
+      else:
+        still_pending.append(i)
+
+    pending = still_pending
+
+  # the ones that never got over the threshold end on the last tier
+  count_tier(tiers[-1], 0, len(pending))
+  return best
\ No newline at end of file
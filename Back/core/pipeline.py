@@ -1,33 +1,112 @@
 from fastapi import HTTPException
-from fastapi.responses import StreamingResponse
 
-from ultralytics import YOLO
-import easyocr
-
-from datetime import datetime
-from io import BytesIO
-from PIL import Image
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+import math
+import time
+import os
 
 # Modules
 from Back.core.ocr import *
+from Back.core.backends import load_yolo, load_reader, load_reference, check_backend, INFERENCE_BACKEND, MODEL_PRECISION
 
 HUNTER_MODEL_PATH = './models/detect/train1/weights/best.pt'
 SURGEON_MODEL_PATH = './models/surgeon/train_v1/weights/best.pt'
-OCR_CONFIDENCE_THRESHOLD = 0.3
 
-async def load_models():
-  print("Loading hunter model...")
-  hunter = YOLO(HUNTER_MODEL_PATH)
+# longest side (px) of the sheet copy the hunter runs on, 0 -> full resolution
+HUNTER_MAX_SIDE = int(os.getenv("HUNTER_MAX_SIDE", 1280))
+
+# max number of sticker crops sent to the surgeon model in one forward pass
+SURGEON_BATCH_SIZE = int(os.getenv("SURGEON_BATCH_SIZE", 16))
+
+# "1" -> the surgeon batch is built from all the sheets of an /upload call instead of one sheet at a time
+SURGEON_BATCH_ACROSS_SHEETS = os.getenv("SURGEON_BATCH_ACROSS_SHEETS", "0") == "1"
+
+# "1" -> skip easyocr's text detector and send the field crops straight to the recognizer (the surgeon already found them)
+OCR_SKIP_DETECTOR = os.getenv("OCR_SKIP_DETECTOR", "0") == "1"
+OCR_BATCH_SIZE = int(os.getenv("OCR_BATCH_SIZE", 16))
 
-  print("Loading surgeon model...")
-  surgeon = YOLO(SURGEON_MODEL_PATH)
+# height (px) of the sticker thumbnails inserted in the report, made once when the sticker is cropped
+THUMBNAIL_HEIGHT = 125
+
+# threads encoding the thumbnails of a sheet (cv2 releases the GIL), 0 -> encoded one by one
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", 0))
+thumbnail_pool = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS) if THUMBNAIL_WORKERS > 0 else None
+
+def timed_load(name, loader, *args):
+  """
+  Runs a loader and prints how long it took
+  """
+  print(f"Loading {name}...")
+  start = time.perf_counter()
+
+  model = loader(*args)
+
+  print(f"Loaded {name} in {time.perf_counter() - start:.1f}s")
+  return model
+
+def load_models():
+  """
+  1- Load the hunter, surgeon and OCR models at the same time (threads, most of it is file io + torch init)
+  2- Self-check the exported / quantized models against pytorch
+  3- Warm up every model so the first real upload doesn't pay for the lazy initialization
+  """
 
-  print("Loading OCR model...")
-  reader = easyocr.Reader(['en', 'ar'], gpu=True)
+  # 1- parallel loading
+  with ThreadPoolExecutor(max_workers=3) as pool:
+    hunter_future = pool.submit(timed_load, f"hunter model ({INFERENCE_BACKEND}, {MODEL_PRECISION})", load_yolo, HUNTER_MODEL_PATH)
+    surgeon_future = pool.submit(timed_load, f"surgeon model ({INFERENCE_BACKEND}, {MODEL_PRECISION})", load_yolo, SURGEON_MODEL_PATH)
+    reader_future = pool.submit(timed_load, "OCR model", load_reader, INFERENCE_BACKEND, not OCR_SKIP_DETECTOR)
+
+    hunter, surgeon, reader = hunter_future.result(), surgeon_future.result(), reader_future.result()
+
+  # 2- self-check of the exported / quantized models against pytorch
+  if INFERENCE_BACKEND != "torch" or MODEL_PRECISION != "fp32":
+    reference = load_reference()
+
+    if reference is not None:
+      # same downscaled copy the hunter gets for a real upload
+      hunter = check_backend(hunter, HUNTER_MODEL_PATH, [working_copy(reference)[0]])
+
+      # the surgeon is checked on the stickers of the reference sheet
+      crops = [reference[y1:y2, x1:x2] for _, (x1, y1, x2, y2) in detect_stickers(hunter, reference)[0]]
+      surgeon = check_backend(surgeon, SURGEON_MODEL_PATH, [c for c in crops if c.size])
+
+  # 3- warm up
+  start = time.perf_counter()
+  warm_up(hunter, surgeon, reader)
+  print(f"Warm up done in {time.perf_counter() - start:.1f}s")
 
   return hunter, surgeon, reader
 
+def synthetic_sheet():
+  """
+  White sheet with one fake sticker (box + text lines), used for the warm up
+  """
+  sheet = np.full((1280, 960, 3), 255, dtype=np.uint8)
+
+  cv2.rectangle(sheet, (80, 80), (620, 380), (0, 0, 0), 2)
+  cv2.putText(sheet, "PATIENT NAME", (110, 160), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 0, 0), 2)
+  cv2.putText(sheet, "2025/01/01", (110, 240), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 0, 0), 2)
+  cv2.putText(sheet, "Nathealth", (110, 320), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 0, 0), 2)
+
+  return sheet
+
+def warm_up(hunter, surgeon, reader):
+  """
+  Runs every model once on the synthetic sheet (first inference, allocator growth, recognizer setup)
+  """
+  sheet = synthetic_sheet()
+  sticker = sheet[80:380, 80:620]
+  field = sheet[120:180, 100:500]
+
+  detect_stickers(hunter, sheet)
+  run_surgeon(surgeon, [sticker])
+
+  # not counted in the ocr tier stats
+  read_crop(reader, field)
+  if OCR_SKIP_DETECTOR:
+    recognize_crops(reader, [field], batch_size=OCR_BATCH_SIZE)
+
 hospital_map = {
   "amman": "مستشفى عمان الجراحي",
   "hayaa": "مستشفى الحياة",
@@ -36,226 +115,262 @@ hospital_map = {
   "other": "Other"
 }
 
-# excel sheet configuration
-# format: ("Column name", column_width)
-excel_structure = [
-  ("المريض", 30),
-  ("تاريخ الدخول", 15),
-  ("تاريخ الخروج", 15),
-  ("ملاحظات", 15),
-  ("Age", 5),
-  ("المستشفى", 20),
-  ("Payment", 20),
-  ("Diagnosis", 25),
-  ("Expected Payment", 15),
-  ("Sticker image", 43),
-  ("File Name", 10)
-]
+def empty_patient(hospital_name, filename, sticker_bytes):
+  """
+  Patient row with every field set to "-" (filled later by the OCR)
+  """
+  return {
+    "المريض": "-",
+    "تاريخ الدخول": "-",
+    "تاريخ الخروج": "-",
+    "ملاحظات": "-",
+    "Age": "-",
+    "المستشفى": hospital_map.get(hospital_name, "Other"),
+    "Payment": "-", # example: cash or insurance company
+    "Diagnosis": "-",
+    "Expected Payment": "-", # expected amount to receive
+    "Sticker image": "", # or u will have text behind the image in the excel file
+    "File Name": filename,
+    "image_data": sticker_bytes
+  }
+
+def working_copy(sheet, max_side=HUNTER_MAX_SIDE):
+  """
+  Downscaled copy of the sheet for the hunter (phone photos are 12-48 MP, the hunter doesn't need that)
+  Returns (copy, scale), the sheet itself if it's already small enough
+  """
+  h, w = sheet.shape[:2]
+  scale = max_side / max(h, w)
 
-def process_sheet(image, hunter, surgeon, reader, filename):
-  final_data = []
-  sheet = image
+  if max_side <= 0 or scale >= 1:
+    return sheet, 1.0
 
-  hunter_results= hunter(sheet, verbose=False)
-  if len(hunter_results[0].boxes) == 0:
-    raise HTTPException(status_code=502, detail="Couldn't find any stickers")
+  small = cv2.resize(sheet, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+  return small, scale
 
-  for _, sticker_box in enumerate(hunter_results[0].boxes):
+def detect_stickers(hunter, sheets):
+  """
+  Runs the hunter model over one or more sheets (one forward pass for all of them)
+  1- Downscale every sheet to HUNTER_MAX_SIDE
+  2- Run the hunter on the small copies
+  3- Map the boxes back to the full resolution sheet (crops are cut from the original only)
+  Returns per sheet a list of (hospital_name, (x1, y1, x2, y2)) in detection order
+  """
+  if isinstance(sheets, np.ndarray): # single sheet
+    sheets = [sheets]
 
-    hospital_id = int(sticker_box.cls[0])
-    hospital_name = hunter.names[hospital_id]
+  # 1- downscale
+  copies = [working_copy(sheet) for sheet in sheets]
 
-    x1, y1, x2, y2 = map(int, sticker_box.xyxy[0])
-    sticker_crop = sheet[y1:y2, x1:x2]
+  # 2- hunter
+  hunter_results = hunter([small for small, _ in copies], verbose=False)
 
-    if sticker_crop.size == 0:
-      continue
+  all_boxes = []
+  for sheet, (_, scale), hunter_result in zip(sheets, copies, hunter_results):
+    h, w = sheet.shape[:2]
+    boxes = []
 
-    if sticker_box.conf[0] <= 0.3: # to handle low confidence predictions
-      hospital_name = "other"
-
-    # Save cropped sticker
-    # convert the numpy array into PNG formatted byte string
-    success, encoded_image = cv2.imencode('.png', sticker_crop)
-    sticker_bytes = encoded_image.tobytes() if success else None
-
-    # case to handle the 'other' class by saving it as ghost patient but only saving the sticker image part
-    if hospital_name == "other":
-      print(f"Found 'other' sticker in {filename}, skipping surgeon model")
-      patient_info = {
-        "المريض": "-",
-        "تاريخ الدخول": "-",
-        "تاريخ الخروج": "-",
-        "ملاحظات": "-",
-        "Age": "-",
-        "المستشفى": hospital_map.get(hospital_name, "Other"),
-        "Payment": "-", # example: cash or insurance company
-        "Diagnosis": "-",
-        "Expected Payment": "-", # expected amount to receive
-        "Sticker image": "",
-        "File Name": filename,
-        "image_data": sticker_bytes,
-      }
+    for sticker_box in hunter_result.boxes:
+      hospital_id = int(sticker_box.cls[0])
+      hospital_name = hunter.names[hospital_id]
 
-      final_data.append(patient_info)
+      if sticker_box.conf[0] <= 0.3: # to handle low confidence predictions
+        hospital_name = "other"
+
+      # 3- back to full resolution (rounded outwards so the sticker isn't cut)
+      x1, y1, x2, y2 = sticker_box.xyxy[0].tolist()
+      full_box = (
+        max(0, math.floor(x1 / scale)),
+        max(0, math.floor(y1 / scale)),
+        min(w, math.ceil(x2 / scale)),
+        min(h, math.ceil(y2 / scale))
+      )
+
+      boxes.append((hospital_name, full_box))
+
+    all_boxes.append(boxes)
+
+  return all_boxes
+
+def make_thumbnail(sticker_crop, height=THUMBNAIL_HEIGHT):
+  """
+  PNG bytes of the sticker resized to the report row (None if the encoding fails)
+  the report inserts these bytes as they are, nothing is decoded or resized again
+  """
+  h, w = sticker_crop.shape[:2]
+  width = max(1, int(w * height / h))
+
+  # area for shrinking (no aliasing), cubic for the rare sticker smaller than the row
+  interpolation = cv2.INTER_AREA if h > height else cv2.INTER_CUBIC
+  thumbnail = cv2.resize(sticker_crop, (width, height), interpolation=interpolation)
+
+  success, encoded_image = cv2.imencode('.png', thumbnail)
+  return encoded_image.tobytes() if success else None
+
+def crop_stickers(image, boxes, filename):
+  """
+  1- Crop every sticker the hunter found
+  2- Make the report thumbnails (THUMBNAIL_WORKERS threads if set)
+  3- Return the stickers (crop + hospital + thumbnail png bytes) in detection order
+  """
+  sheet = image
+
+  if len(boxes) == 0:
+    raise HTTPException(status_code=502, detail="Couldn't find any stickers")
+
+  # 1- crop
+  crops = []
+  for hospital_name, (x1, y1, x2, y2) in boxes:
+    sticker_crop = sheet[y1:y2, x1:x2]
+
+    if sticker_crop.size == 0:
       continue
 
-    surgeon_result = surgeon(sticker_crop, verbose=False)
-
-    # this is temp, used to convert the image_data into an image
-    patient_info = {
-      "المريض": "-",
-      "تاريخ الدخول": "-",
-      "تاريخ الخروج": "-",
-      "ملاحظات": "-",
-      "Age": "-",
-      "المستشفى": hospital_map.get(hospital_name, "Other"),
-      "Payment": "-", # example: cash or insurance company
-      "Diagnosis": "-",
-      "Expected Payment": "-", # expected amount to receive
-      "Sticker image": "", # or u will have text behind the image in the excel file
-      "File Name": filename,
-      "image_data": sticker_bytes
+    crops.append((hospital_name, sticker_crop))
+
+  # 2- thumbnails
+  sticker_crops = [sticker_crop for _, sticker_crop in crops]
+  if thumbnail_pool:
+    thumbnails = list(thumbnail_pool.map(make_thumbnail, sticker_crops))
+  else:
+    thumbnails = [make_thumbnail(sticker_crop) for sticker_crop in sticker_crops]
+
+  # 3- stickers
+  return [
+    {
+      "hospital_name": hospital_name,
+      "crop": sticker_crop,
+      "filename": filename,
+      "image_data": thumbnail
     }
+    for (hospital_name, sticker_crop), thumbnail in zip(crops, thumbnails)
+  ]
 
-    names_map = surgeon.names
+def find_stickers(image, hunter, filename):
+  """
+  Hunter + crops for a single sheet
+  """
+  return crop_stickers(image, detect_stickers(hunter, image)[0], filename)
 
-    # special case check
-    if hospital_name == "amman":
-      detected_classes = [names_map[int(box.cls[0])] for box in surgeon_result[0].boxes]
-      if "field_payment" not in detected_classes:
-        patient_info["Payment"] = "Cash"
+def run_surgeon(surgeon, crops):
+  """
+  Runs the surgeon model over all the crops as batches of SURGEON_BATCH_SIZE
+  instead of one forward pass per sticker (most of the cost on cpu is the per call overhead)
+  Returns one result per crop, in the same order
+  """
+  results = []
 
-    for box in surgeon_result[0].boxes:
-      class_id = int(box.cls[0])
-      class_name = names_map[class_id]
+  for i in range(0, len(crops), SURGEON_BATCH_SIZE):
+    results.extend(surgeon(crops[i:i + SURGEON_BATCH_SIZE], verbose=False))
 
-      bx1, by1, bx2, by2 = map(int, box.xyxy[0])
-      field_cropped = sticker_crop[by1:by2, bx1:bx2]
+  return results
 
-      text, confidence = get_best_ocr(reader, field_cropped)
+def find_fields(sticker, surgeon_result, surgeon):
+  """
+  Crops every field box the surgeon found in the sticker
+  Returns a list of (class_name, field_crop)
+  """
+  sticker_crop = sticker["crop"]
+  names_map = surgeon.names
+
+  fields = []
+  for box in surgeon_result.boxes:
+    class_id = int(box.cls[0])
+    class_name = names_map[class_id]
 
-      if confidence < OCR_CONFIDENCE_THRESHOLD:
-        final_value = "-"
-      else:
-        final_value = clean_text(text)
+    bx1, by1, bx2, by2 = map(int, box.xyxy[0])
+    fields.append((class_name, sticker_crop[by1:by2, bx1:bx2]))
 
-      if class_name == "field_name":
-        # the ocr model sometimes confuses the name field by saying "nathealth" instead, it's an insurance, not a name
-        if "nathealth" in final_value.lower() or "nat" in final_value.lower():
-          continue
+  return fields
 
-        patient_info["المريض"] = final_value
+def read_fields(reader, field_crops):
+  """
+  Reads the text of all the field crops, returns (text, confidence) per crop
+  OCR_SKIP_DETECTOR -> one recognizer only batch instead of readtext on every crop
+  both escalate through OCR_TIERS only for the crops under OCR_CONFIDENCE_THRESHOLD
+  """
+  if OCR_SKIP_DETECTOR:
+    return get_batch_ocr(reader, field_crops, batch_size=OCR_BATCH_SIZE)
 
-      elif class_name == "field_date":
-        patient_info["تاريخ الدخول"] = standardize_date(final_value)
+  return [get_best_ocr(reader, crop) for crop in field_crops]
 
-      elif class_name == "field_age":
-        patient_info["Age"] = clean_age(final_value)
+def fill_field(patient_info, class_name, text, confidence):
+  """
+  Cleans the scanned text and puts it in the right column of the patient
+  """
+  if confidence < OCR_CONFIDENCE_THRESHOLD:
+    final_value = "-"
+  else:
+    final_value = clean_text(text)
 
-      elif class_name == "field_payment":
-        patient_info["Payment"] = clean_payment(final_value)
+  if class_name == "field_name":
+    # the ocr model sometimes confuses the name field by saying "nathealth" instead, it's an insurance, not a name
+    if payment_matcher.is_name_misread(final_value):
+      return
 
-    final_data.append(patient_info)
+    patient_info["المريض"] = final_value
 
-  return final_data
+  elif class_name == "field_date":
+    patient_info["تاريخ الدخول"] = standardize_date(final_value)
 
+  elif class_name == "field_age":
+    patient_info["Age"] = clean_age(final_value)
 
+  elif class_name == "field_payment":
+    patient_info["Payment"] = clean_payment(final_value)
 
-def save_data(patient_data):
+def read_stickers(stickers, surgeon, reader):
   """
-  1- Convert the received dict into dataframe
-  2- Create temp df based off the defined excel structure
-  3- Write patient data into an excel sheet
-  4- Insert images into the created excel sheet
+  1- Gather every non "other" sticker (can be from more than one sheet)
+  2- Run the surgeon model over all of them as one batch
+  3- Map the field boxes back to their sticker
+  4- OCR all the fields at once
+  5- Return one patient row per sticker, in the same order as the stickers
   """
-  if not patient_data:
-    raise HTTPException(status_code=502, detail="Couldn't extract data from stickers")
-
-  # 1- create df
-  df = pd.DataFrame(patient_data)
-
-  # 2- temp df for writing text (without the "image_data")
-  
-  # Columns' name based on the excel_structure
-  display_cols = [col[0] for col in excel_structure]
-
-  # Filtered df to match these columns
-  df_export = df[ [c for c in display_cols if c in df.columns] ]
-
-  # 3- write patient_data into the excel sheet
-  # in memory buffer
-  output = BytesIO()
-
-  with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-    df_export.to_excel(writer, index=False, sheet_name="Sheet1")
-
-    # 4- insert images into the excel sheet "Sheet1"
-
-    # worksheet configurations
-    # Get the xlsxwriter objects that pandas is using under the hood
-    workbook = writer.book
-    worksheet = writer.sheets['Sheet1']
-    worksheet.right_to_left()
-
-    # EXTRA, this is just to have all the columns' width fitted nicely
-    for i, (col_name, width) in enumerate(excel_structure):
-      worksheet.set_column(i, i, width)
-
-
-    img_col_index = display_cols.index("Sticker image")
-    # IN the original df to get image_data
-    for i, row_data in df.iterrows():
-      image_bytes = row_data.get('image_data')
-
-      if image_bytes:
-
-        # calculate excel row
-        excel_row = i + 1 # note: row 0 is header
-
-        worksheet.set_row(excel_row, 100) # current row height = 100
-
-        # insert the image
-        image_stream = BytesIO(image_bytes)
-        
-        # image resizing to fit the change from embed_image to insert_image
-        with Image.open(BytesIO(image_bytes)) as img:
-          # 1- calculate the new dimensions
-          target_height = 125
-          aspect_ratio = img.width / img.height
-          new_width = int(target_height * aspect_ratio)
-          
-          # 2- resize the image (look up: high quality downsampling algorithm)
-          img_resized = img.resize((new_width, target_height), Image.Resampling.LANCZOS)
-          
-          # 3- save to the new buffer
-          image_stream = BytesIO()
-          img_resized.save(image_stream, format="PNG")
-          image_stream.seek(0)
-        
-        
-        # explanation:
-        # insert_image instead of embed_image because in 'embed_image'
-        # the image is literally the value of the cell
-        # and i had to change this cuz the merge endpoint when copying the image, it couldnt see the value in the cell
-        worksheet.insert_image(
-          excel_row,
-          img_col_index, # Sticker image column
-          "sticker.png", # Dummy file name
-          {
-            'image_data': image_stream,
-            'object_position': 1,
-            'x_offset': 5,
-            'y_offset': 5
-            # no need for rescaling cuz the resizing part did it already
-          }
-        )
-
-  output.seek(0)
-
-  filename_str = datetime.datetime.now().strftime("Report_%Y-%m-%d_%H-%M.xlsx")
-  return StreamingResponse(
-    output,
-    media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-    headers={"Content-Disposition": f"attachment; filename={filename_str}"}
-  )
\ No newline at end of file
+
+  # 1- "other" stickers are saved as ghost patients, only the sticker image part
+  pending = [i for i, sticker in enumerate(stickers) if sticker["hospital_name"] != "other"]
+
+  # 2- batched surgeon
+  surgeon_results = run_surgeon(surgeon, [stickers[i]["crop"] for i in pending])
+
+  # 3- map back
+  sticker_fields = {
+    i: find_fields(stickers[i], result, surgeon)
+    for i, result in zip(pending, surgeon_results)
+  }
+
+  # 4- ocr
+  all_crops = [crop for i in pending for _, crop in sticker_fields[i]]
+  ocr_results = iter(read_fields(reader, all_crops))
+
+  # 5- fill the patients
+  final_data = []
+  for i, sticker in enumerate(stickers):
+    hospital_name = sticker["hospital_name"]
+    patient_info = empty_patient(hospital_name, sticker["filename"], sticker["image_data"])
+
+    if i not in sticker_fields:
+      print(f"Found 'other' sticker in {sticker['filename']}, skipping surgeon model")
+      final_data.append(patient_info)
+      continue
+
+    fields = sticker_fields[i]
+
+    # special case check
+    if hospital_name == "amman":
+      detected_classes = [class_name for class_name, _ in fields]
+      if "field_payment" not in detected_classes:
+        patient_info["Payment"] = "Cash"
+
+    for class_name, _ in fields:
+      text, confidence = next(ocr_results)
+      fill_field(patient_info, class_name, text, confidence)
+
+    final_data.append(patient_info)
+
+  return final_data
+
+def process_sheet(image, hunter, surgeon, reader, filename):
+  stickers = find_stickers(image, hunter, filename)
+  return read_stickers(stickers, surgeon, reader)
\ No newline at end of file
@@ -0,0 +1,139 @@
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+from tempfile import SpooledTemporaryFile, TemporaryDirectory
+import xlsxwriter
+import datetime
+import os
+
+# excel sheet configuration
+# format: ("Column name", column_width)
+excel_structure = [
+  ("المريض", 30),
+  ("تاريخ الدخول", 15),
+  ("تاريخ الخروج", 15),
+  ("ملاحظات", 15),
+  ("Age", 5),
+  ("المستشفى", 20),
+  ("Payment", 20),
+  ("Diagnosis", 25),
+  ("Expected Payment", 15),
+  ("Sticker image", 43),
+  ("File Name", 10)
+]
+
+# reports bigger than this go from RAM to a temp file on disk
+REPORT_SPOOL_BYTES = int(os.getenv("REPORT_SPOOL_BYTES", 8 * 1024 * 1024))
+
+# size of the pieces the report is sent in
+REPORT_CHUNK_BYTES = 64 * 1024
+
+def write_report(patient_data, output, tmpdir):
+  """
+  Writes the rows one by one with xlsxwriter's constant_memory mode (a row is flushed to disk once the next one starts)
+  1- Header + column widths + RTL
+  2- One row per patient, text columns from excel_structure
+  3- The sticker thumbnail goes through a file in tmpdir, xlsxwriter only copies it into the zip when closing
+  Returns the number of rows written
+  """
+  workbook = xlsxwriter.Workbook(output, {"constant_memory": True, "tmpdir": tmpdir})
+  worksheet = workbook.add_worksheet("Sheet1")
+
+  # 1- worksheet configurations
+  worksheet.right_to_left()
+
+  display_cols = [col[0] for col in excel_structure]
+  img_col_index = display_cols.index("Sticker image")
+
+  # EXTRA, this is just to have all the columns' width fitted nicely
+  for i, (col_name, width) in enumerate(excel_structure):
+    worksheet.set_column(i, i, width)
+
+  # same look as the header pandas used to write
+  header_format = workbook.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+  worksheet.write_row(0, 0, display_cols, header_format)
+
+  # 2- rows
+  rows = 0
+  for row_data in patient_data:
+    rows += 1
+    excel_row = rows # note: row 0 is header
+
+    image_bytes = row_data.get("image_data")
+    if image_bytes:
+      worksheet.set_row(excel_row, 100) # current row height = 100 (before the row is written, constant_memory)
+
+    worksheet.write_row(excel_row, 0, [row_data.get(col, "") for col in display_cols])
+
+    # 3- insert the image
+    if image_bytes:
+      image_path = os.path.join(tmpdir, f"sticker_{excel_row}.png")
+      with open(image_path, "wb") as f:
+        f.write(image_bytes)
+
+      # explanation:
+      # insert_image instead of embed_image because in 'embed_image'
+      # the image is literally the value of the cell
+      # and i had to change this cuz the merge endpoint when copying the image, it couldnt see the value in the cell
+      worksheet.insert_image(
+        excel_row,
+        img_col_index, # Sticker image column
+        image_path,
+        {
+          'object_position': 1,
+          'x_offset': 5,
+          'y_offset': 5
+          # no need for rescaling, the thumbnail already has the row size (see make_thumbnail)
+        }
+      )
+
+  workbook.close()
+  return rows
+
+def build_report(patient_data):
+  """
+  Writes the excel report of the patients (a list or any generator of rows) into a spooled temp file
+  Returns the file, at position 0
+  """
+  output = SpooledTemporaryFile(max_size=REPORT_SPOOL_BYTES)
+
+  try:
+    with TemporaryDirectory(prefix="report_") as tmpdir:
+      rows = write_report(patient_data, output, tmpdir)
+
+    if rows == 0:
+      raise HTTPException(status_code=502, detail="Couldn't extract data from stickers")
+
+  except BaseException:
+    output.close()
+    raise
+
+  output.seek(0)
+  return output
+
+def read_chunks(output):
+  """
+  Yields the report in REPORT_CHUNK_BYTES pieces and closes it at the end
+  """
+  try:
+    while chunk := output.read(REPORT_CHUNK_BYTES):
+      yield chunk
+  finally:
+    output.close()
+
+def report_response(output):
+  """
+  Streams a finished report file (or buffer) as a download
+  """
+  filename_str = datetime.datetime.now().strftime("Report_%Y-%m-%d_%H-%M.xlsx")
+  return StreamingResponse(
+    read_chunks(output),
+    media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    headers={"Content-Disposition": f"attachment; filename={filename_str}"}
+  )
+
+def save_data(patient_data):
+  """
+  Builds the excel report and sends it as a download
+  """
+  return report_response(build_report(patient_data))
\ No newline at end of file
@@ -0,0 +1,187 @@
+from fastapi import HTTPException, status, UploadFile
+from starlette.datastructures import Headers
+
+from python_multipart import MultipartParser
+from python_multipart.multipart import parse_options_header
+from tempfile import SpooledTemporaryFile
+import os
+
+# caps checked while the body is being received (413 as soon as one is crossed)
+UPLOAD_MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_BYTES", 25 * 1024 * 1024))
+UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", 80 * 1024 * 1024))
+
+# bigger files than this go from RAM to a temp file on disk
+UPLOAD_SPOOL_BYTES = 1024 * 1024
+
+# for the docs, the body isn't declared as File(...) so fastapi doesn't parse it before the endpoint
+UPLOAD_OPENAPI = {
+  "requestBody": {
+    "required": True,
+    "content": {
+      "multipart/form-data": {
+        "schema": {
+          "type": "object",
+          "properties": {"images": {"type": "array", "items": {"type": "string", "format": "binary"}}},
+          "required": ["images"]
+        }
+      }
+    }
+  }
+}
+
+def too_large(detail):
+  return HTTPException(status_code=status.HTTP_413_CONTENT_TOO_LARGE, detail=detail)
+
+def check_upload_headers(request):
+  """
+  Checks the headers before anything is received (call it before charging the user)
+  1- 400 if the Content-Length isn't a number, 413 if it's over the request cap
+  2- 400 if it's not a multipart upload
+  Returns the multipart boundary
+  """
+
+  # 1- size
+  content_length = request.headers.get("content-length")
+  if content_length:
+    try:
+      length = int(content_length)
+    except ValueError:
+      length = -1
+
+    if length < 0:
+      raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid Content-Length header")
+
+    if length > UPLOAD_MAX_REQUEST_BYTES:
+      raise too_large(f"The upload is bigger than {UPLOAD_MAX_REQUEST_BYTES // (1024 * 1024)} MB")
+
+  # 2- type
+  content_type, params = parse_options_header(request.headers.get("content-type", ""))
+  if content_type != b"multipart/form-data" or b"boundary" not in params:
+    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Expected a multipart/form-data upload")
+
+  return params[b"boundary"]
+
+async def stream_uploads(request, field="images", max_files=None):
+  """
+  Reads the multipart body chunk by chunk and yields every file as soon as it's complete
+  (spooled to disk after UPLOAD_SPOOL_BYTES), so the caller can process and release it before the next one is received
+  1- Check the headers (same as check_upload_headers)
+  2- Parse the chunks, the file data goes straight to a spooled temp file
+  3- 413 as soon as a file or the whole request crosses its cap
+  """
+
+  # 1- early check
+  boundary = check_upload_headers(request)
+
+  # 2- parser state (the callbacks are sync, finished files are collected and yielded after each chunk)
+  state = {"headers": [], "field": b"", "value": b"", "file": None, "size": 0, "count": 0}
+  finished = []
+
+  def on_part_begin():
+    state["headers"] = []
+
+  def on_header_field(data, start, end):
+    state["field"] += data[start:end]
+
+  def on_header_value(data, start, end):
+    state["value"] += data[start:end]
+
+  def on_header_end():
+    state["headers"].append((state["field"].lower(), state["value"]))
+    state["field"], state["value"] = b"", b""
+
+  def on_headers_finished():
+    headers = Headers(raw=state["headers"])
+    _, options = parse_options_header(headers.get("content-disposition", ""))
+
+    # only the file parts of the expected field are kept
+    if options.get(b"name", b"").decode() != field or b"filename" not in options:
+      state["file"] = None
+      return
+
+    state["count"] += 1
+    if max_files is not None and state["count"] > max_files:
+      raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_CONTENT, detail=f"Maximum of {max_files} images is allowed!")
+
+    state["size"] = 0
+    state["file"] = UploadFile(
+      SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES),
+      filename=options[b"filename"].decode(),
+      headers=headers
+    )
+
+  def on_part_data(data, start, end):
+    upload = state["file"]
+    if upload is None:
+      return
+
+    # 3- per file cap
+    state["size"] += end - start
+    if state["size"] > UPLOAD_MAX_FILE_BYTES:
+      raise too_large(f"{upload.filename} is bigger than {UPLOAD_MAX_FILE_BYTES // (1024 * 1024)} MB")
+
+    upload.file.write(data[start:end])
+
+  def on_part_end():
+    upload = state["file"]
+    if upload is not None:
+      upload.file.seek(0)
+      upload.size = state["size"]
+      finished.append(upload)
+      state["file"] = None
+
+  parser = MultipartParser(boundary, {
+    "on_part_begin": on_part_begin,
+    "on_part_data": on_part_data,
+    "on_part_end": on_part_end,
+    "on_header_field": on_header_field,
+    "on_header_value": on_header_value,
+    "on_header_end": on_header_end,
+    "on_headers_finished": on_headers_finished,
+  })
+
+  received = 0
+  try:
+    async for chunk in request.stream():
+
+      # 3- per request cap (also covers chunked uploads without a Content-Length)
+      received += len(chunk)
+      if received > UPLOAD_MAX_REQUEST_BYTES:
+        raise too_large(f"The upload is bigger than {UPLOAD_MAX_REQUEST_BYTES // (1024 * 1024)} MB")
+
+      parser.write(chunk)
+
+      while finished:
+        yield finished.pop(0)
+
+    parser.finalize()
+    while finished:
+      yield finished.pop(0)
+
+  finally:
+    # files that were never handed out
+    for upload in finished + ([state["file"]] if state["file"] else []):
+      await upload.close()
+
+
+async def close_uploads(uploads):
+  for upload in uploads:
+    await upload.close()
+
+async def receive_uploads(request, field="images", max_files=None):
+  """
+  Receives the whole body (spooled temp files) before anything is processed
+  so the 413 / 422 of the caps come before the user is charged and before any inference runs
+  Returns the uploads, the caller closes them (process_images does it image by image)
+  """
+  uploads = []
+
+  try:
+    async for upload in stream_uploads(request, field, max_files):
+      uploads.append(upload)
+
+  except BaseException:
+    await close_uploads(uploads)
+    raise
+
+  return uploads
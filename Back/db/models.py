@@ -1,7 +1,7 @@
 import uuid
-from sqlalchemy import Uuid, String, Boolean, DateTime, ForeignKey, Integer
+from sqlalchemy import Uuid, String, Text, Boolean, DateTime, Date, ForeignKey, Integer, Index
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from datetime import datetime, timezone
+from datetime import datetime, date, timezone
 
 
 class Base(DeclarativeBase):
@@ -54,4 +54,75 @@ class RefreshToken(Base):
   # user id associated with the token
   user_id: Mapped[uuid.UUID] = mapped_column(Uuid, ForeignKey("users.id"), nullable=False)
   
-  user: Mapped["User"] = relationship()
\ No newline at end of file
+  user: Mapped["User"] = relationship()
+  
+  
+  
+class Upload(Base):
+  __tablename__ = "uploads"
+  
+  # one row per /upload call or job (a batch of sheets)
+  id: Mapped[uuid.UUID] = mapped_column(Uuid, primary_key=True, default=uuid.uuid4)
+  
+  owner_id: Mapped[uuid.UUID] = mapped_column(Uuid, ForeignKey("users.id"), nullable=False)
+  created_at: Mapped[datetime] = mapped_column(DateTime, default= lambda : datetime.now(timezone.utc).replace(tzinfo=None))
+  
+  # "upload" | "job"
+  source: Mapped[str] = mapped_column(String(16), default="upload")
+  
+  # sheets that gave at least one patient
+  images: Mapped[int] = mapped_column(Integer, default=0)
+  patients: Mapped[int] = mapped_column(Integer, default=0)
+  
+  __table_args__ = (
+    Index("ix_uploads_owner_created", "owner_id", "created_at"),
+  )
+  
+  
+  
+class PatientRecord(Base):
+  __tablename__ = "patient_records"
+  
+  # increasing id, used as the keyset cursor (newest first)
+  id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+  
+  upload_id: Mapped[uuid.UUID] = mapped_column(Uuid, ForeignKey("uploads.id", ondelete="CASCADE"), index=True, nullable=False)
+  owner_id: Mapped[uuid.UUID] = mapped_column(Uuid, ForeignKey("users.id"), nullable=False)
+  
+  # the report columns (as the OCR read them, "-" when empty)
+  # Text: the raw OCR fallbacks (unparsed date, unmatched payment...) have no max length
+  name: Mapped[str] = mapped_column(Text, default="-")
+  admission_date_text: Mapped[str] = mapped_column(Text, default="-")
+  age: Mapped[str] = mapped_column(Text, default="-")
+  hospital: Mapped[str] = mapped_column(Text, default="Other")
+  payment: Mapped[str] = mapped_column(Text, default="-")
+  file_name: Mapped[str] = mapped_column(Text, default="")
+  
+  # parsed admission date (None if the OCR text isn't a YYYY/MM/DD date), for the date filters
+  admission_date: Mapped[date | None] = mapped_column(Date, nullable=True)
+  
+  # content hash of the sticker thumbnail ("" if none), its key in the blob store
+  sticker_id: Mapped[str] = mapped_column(String(32), default="")
+  
+  created_at: Mapped[datetime] = mapped_column(DateTime, default= lambda : datetime.now(timezone.utc).replace(tzinfo=None))
+  
+  # every query is scoped to the owner, the id at the end keeps the keyset pages on the index
+  __table_args__ = (
+    Index("ix_patient_records_owner_id", "owner_id", "id"),
+    Index("ix_patient_records_owner_hospital", "owner_id", "hospital", "id"),
+    Index("ix_patient_records_owner_payment", "owner_id", "payment", "id"),
+    Index("ix_patient_records_owner_admission", "owner_id", "admission_date", "id"),
+    Index("ix_patient_records_owner_sticker", "owner_id", "sticker_id"),
+  )
+  
+  
+  
+class MasterReport(Base):
+  __tablename__ = "master_reports"
+  
+  # a user's master report is every patient_records row after starts_after (no row -> all of them)
+  owner_id: Mapped[uuid.UUID] = mapped_column(Uuid, ForeignKey("users.id"), primary_key=True)
+  
+  # last patient_records id when the user cleared the report
+  starts_after: Mapped[int] = mapped_column(Integer, default=0)
+  cleared_at: Mapped[datetime] = mapped_column(DateTime, default= lambda : datetime.now(timezone.utc).replace(tzinfo=None))
@@ -1,7 +1,8 @@
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, status, Request
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy import update, case, or_
 from jwt import PyJWTError
 from datetime import datetime, timezone
 import jwt
@@ -11,6 +12,7 @@ from Back.db.database import get_db
 from Back.db.models import User
 from Back.services.auth import is_token_blacklisted, SECRET_KEY, ALGORITHM
 from Back.services.redis_client import get_redis
+from Back.services.user_cache import load_user, invalidate_user
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 MAX_REQUESTS = 10
@@ -26,12 +28,8 @@ async def get_current_user(
     headers={"WWW-Authenticate": "Bearer"},
   )
   
-  # 1- Check if token is blacklisted
-  if await is_token_blacklisted(token, redis):
-    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token is invalid (Logged out)")
-  
   try:
-    # 2- Decode token
+    # 1- Decode token
     payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     username: str = payload.get("sub")
     
@@ -41,9 +39,12 @@ async def get_current_user(
   except PyJWTError:
     raise credentials_exception
   
-  # 3- Get User from DB
-  result = await db.execute(select(User).where(User.username == username))
-  user = result.scalars().first()
+  # 2- Check if token is blacklisted (by its jti, redis is only asked if the local filter may have it)
+  if await is_token_blacklisted(payload, token, redis):
+    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token is invalid (Logged out)")
+  
+  # 3- Get User (in process cache, else the db)
+  user = await load_user(username, db)
   
   if user is None:
     raise credentials_exception
@@ -56,6 +57,23 @@ async def get_current_user(
 
 
 
+def check_daily_limit(user: User):
+  """
+  429 if the user has no requests left today, nothing is charged
+  (used before receiving an upload, check_rate_limit charges once it's accepted)
+  """
+  now = datetime.now(timezone.utc)
+  
+  count = user.request_count
+  if user.last_request is None or user.last_request.date() < now.date():
+    count = 0
+  
+  if not user.is_unlimited and count >= MAX_REQUESTS:
+    raise HTTPException(
+      status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+      detail="Daily limit reached, Please come back tomorrow."
+    )
+
 async def check_rate_limit(
         user: User,
         db: AsyncSession
@@ -63,28 +81,55 @@ async def check_rate_limit(
   """
   Checks if the user has reached their maximum request limits for the day
   True -> can upload
-  False -> can NOT upload
+  429 -> can NOT upload
   
-  1- Checks for a new day
-  2- Check is not unlimited and reached max count
-  3- if none, increase request counter and update last request
+  1- One UPDATE does the checks and the charge in the db (never from the cached row, other replicas charge too)
+     new day -> count starts again at 1, else +1 only if unlimited or under MAX_REQUESTS
+  2- No row updated -> the limit was reached
+  3- The request's user gets the new counters, the cached copies are dropped
   """
   now = datetime.now(timezone.utc)
   now_tz = now.replace(tzinfo=None)
-
-  if user.last_request is None or user.last_request.date() < now.date():
-    user.request_count = 0
-    
-  if not user.is_unlimited and user.request_count >= MAX_REQUESTS:
+  today = now_tz.replace(hour=0, minute=0, second=0, microsecond=0)
+  
+  # 1- check + charge
+  new_day = or_(User.last_request.is_(None), User.last_request < today)
+  
+  result = await db.execute(
+    update(User)
+    .where(User.id == user.id, or_(User.is_unlimited, new_day, User.request_count < MAX_REQUESTS))
+    .values(request_count=case((new_day, 1), else_=User.request_count + 1), last_request=now_tz)
+    .returning(User.request_count)
+    .execution_options(synchronize_session=False)
+  )
+  request_count = result.scalar()
+  
+  # 2- limit reached
+  if request_count is None: # nothing was written, the session's transaction ends with the request
     raise HTTPException(
       status_code=status.HTTP_429_TOO_MANY_REQUESTS,
       detail="Daily limit reached, Please come back tomorrow."
     )
   
-  user.request_count += 1
-  user.last_request = now_tz
-  
   await db.commit()
-  await db.refresh(user)
+  
+  # 3- no flush of these, they are what the db already has
+  set_committed_value(user, "request_count", request_count)
+  set_committed_value(user, "last_request", now_tz)
+  
+  await invalidate_user(user.username)
+  
+  return True
+
+
+async def check_ready(request: Request):
+  """
+  Rejects inference requests until the models are loaded and warmed up
+  """
+  if not getattr(request.app.state, "ready", False):
+    raise HTTPException(
+      status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+      detail="The server is warming up, please try again in a moment"
+    )
   
   return True
\ No newline at end of file
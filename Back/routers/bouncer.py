@@ -1,4 +1,4 @@
-from fastapi import FastAPI, APIRouter, Header, status, HTTPException, Depends
+from fastapi import FastAPI, APIRouter, Header, status, HTTPException, Depends, Request
 
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
@@ -16,14 +16,10 @@ router = APIRouter(
 
 load_dotenv()
 
-# bot bouncer
-@router.get("/keep-alive")
-async def keep_alive(
-        x_keep_alive_token: str = Header(None),
-        db: AsyncSession = Depends(get_db),
-        redis_client = Depends(get_redis)
-):
-  
+async def check_keep_alive_token(x_keep_alive_token: str = Header(None)):
+  """
+  Only our own pingers / dashboards know the token, everyone else gets a 403
+  """
   expected_token = os.getenv("KEEP_ALIVE_TOKEN")
   
   # checks if it is a random bot
@@ -31,6 +27,16 @@ async def keep_alive(
     raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                         detail="Forbidden")
   
+  return True
+
+# bot bouncer
+@router.get("/keep-alive")
+async def keep_alive(
+        allowed: bool = Depends(check_keep_alive_token),
+        db: AsyncSession = Depends(get_db),
+        redis_client = Depends(get_redis)
+):
+  
   # if it isn't, it pokes the db to keep a connection opened and ping redis client
   try:
     await db.execute(text("SELECT 1"))
@@ -40,4 +46,41 @@ async def keep_alive(
     return {"status": "success", "message": "Supabase and Redis are awake"}
   
   except Exception as e:
-    raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Database ping or redis failed")
\ No newline at end of file
+    raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Database ping or redis failed")
+
+
+# orchestrator readiness probe
+@router.get("/ready")
+async def ready(request: Request):
+  """
+  200 only once the models are loaded and warmed up, so traffic only goes to hot replicas
+  """
+  if not getattr(request.app.state, "ready", False):
+    raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Models are still loading")
+  
+  return {"status": "ready"}
+
+
+@router.get("/cache-stats")
+async def cache_stats(request: Request, allowed: bool = Depends(check_keep_alive_token)):
+  """
+  Hit / miss counters of the result cache (since this replica started)
+  """
+  cache = getattr(request.app.state, "result_cache", None)
+  
+  if cache is None:
+    return {"backend": "off"}
+  
+  return cache.stats()
+
+
+@router.get("/ocr-stats")
+async def ocr_stats(request: Request, allowed: bool = Depends(check_keep_alive_token)):
+  """
+  How often each OCR preprocessing tier runs, and how often it's the one that gave the final text
+  summed over all the inference workers, read directly (never queued behind the real jobs)
+  """
+  if not getattr(request.app.state, "ready", False):
+    raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Models are still loading")
+  
+  return request.app.state.inference.ocr_stats()
\ No newline at end of file
@@ -0,0 +1,154 @@
+from fastapi import APIRouter, Depends, HTTPException, status, Request, BackgroundTasks, Query
+from fastapi.concurrency import run_in_threadpool
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Modules
+from Back.core.export import export_response, check_export, ExportFormat, ImageMode
+from Back.core.ingest import process_images
+from Back.core.uploads import check_upload_headers, receive_uploads, close_uploads, UPLOAD_OPENAPI
+from Back.services.jobs import create_job, get_job, update_job, save_results, get_results
+from Back.services.result_cache import dump_records, load_records
+from Back.services.rate_limiter import check_user_cooldown
+from Back.services.redis_client import get_redis, get_redis_client
+from Back.routers.upload import MAX_IMAGES, save_patients
+from Back.db.models import User
+from Back.db.database import get_db
+from Back.dependencies import get_current_user, check_rate_limit, check_daily_limit, check_ready
+
+router = APIRouter(
+  prefix="/jobs",
+  tags=["Jobs"]
+)
+
+async def run_job(job_id: str, owner_id, images: list, inference, batcher, cache, blob_store):
+  """
+  Background part of POST /jobs
+  1- Process the images and save each image's progress
+  2- Save the patient rows next to the job (the report is made from them on download)
+  3- Save them (patient_records table + blob store, the user's master report is made from them)
+  """
+  redis = get_redis_client()
+
+  async def on_progress(index, state, patients):
+    await update_job(job_id, redis, image_index=index, status=state, patients=patients)
+
+  try:
+    await update_job(job_id, redis, status="running")
+
+    # 1- process (waits for a free worker instead of failing on a full queue)
+    all_patient_data = await process_images(images, inference, on_progress, batcher, cache, wait_for_workers=True)
+
+    if not all_patient_data:
+      await update_job(job_id, redis, status="failed", detail="No patients found in any of the uploaded images")
+      return
+
+    # 2- results
+    results = await run_in_threadpool(dump_records, all_patient_data)
+    await save_results(job_id, results, redis)
+
+    await update_job(job_id, redis, status="done", patients=len(all_patient_data))
+
+    # 3- patient records + stickers (after "done", the report doesn't wait for them)
+    await save_patients(owner_id, all_patient_data, blob_store, source="job")
+
+  except Exception as e:
+    print(f"Job {job_id} failed, Error: {e}")
+    await update_job(job_id, redis, status="failed", detail="Failed to process the images")
+
+  finally:
+    await close_uploads(images) # the ones never reached if the job failed, closing twice is fine
+    await redis.close()
+
+async def get_own_job(job_id: str, user: User, redis):
+  """
+  Returns the job if it exists and belongs to the user
+  """
+  job = await get_job(job_id, redis)
+
+  # same error for "not yours" so job ids can't be probed
+  if job is None or job["owner"] != str(user.id):
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found (or expired)")
+
+  return job
+
+
+@router.post("", status_code=status.HTTP_202_ACCEPTED, openapi_extra=UPLOAD_OPENAPI)
+async def submit_job(
+        request: Request,
+        background_tasks: BackgroundTasks,
+        ready: bool = Depends(check_ready),
+        user: User = Depends(get_current_user),
+        cooldown: bool = Depends(check_user_cooldown),
+        db: AsyncSession = Depends(get_db),
+        redis = Depends(get_redis)
+):
+  """
+  Same input as /upload but returns a job id right away
+  1- Check the upload headers + if the user has requests left (nothing charged yet)
+  2- Receive the images (spooled temp files, same caps as /upload), they are closed by the background task
+  3- Charge the user's daily limit once the upload was accepted
+  4- Create the job and start it in the background
+  """
+
+  # 1- checks
+  check_upload_headers(request)
+  check_daily_limit(user)
+
+  # 2- receive
+  job_images = await receive_uploads(request, max_files=MAX_IMAGES)
+
+  # 3- charge
+  try:
+    await check_rate_limit(user=user, db=db) # already handles errors
+
+  except BaseException:
+    await close_uploads(job_images)
+    raise
+
+  # 4- create + start
+  job_id = await create_job(user.id, [image.filename for image in job_images], redis)
+  state = request.app.state
+  background_tasks.add_task(run_job, job_id, user.id, job_images, state.inference, state.hunter_batcher, state.result_cache, state.blob_store)
+
+  return {"job_id": job_id, "status": "queued"}
+
+
+@router.get("/{job_id}")
+async def job_status(
+        job_id: str,
+        user: User = Depends(get_current_user),
+        redis = Depends(get_redis)
+):
+  job = await get_own_job(job_id, user, redis)
+  job.pop("owner")
+
+  return job
+
+
+@router.get("/{job_id}/report")
+async def job_report(
+        job_id: str,
+        export_format: ExportFormat = Query("xlsx", alias="format"),
+        images: ImageMode = Query("none"),
+        user: User = Depends(get_current_user),
+        redis = Depends(get_redis)
+):
+  """
+  Same formats as /upload (xlsx report by default)
+  """
+  check_export(export_format, images)
+  job = await get_own_job(job_id, user, redis)
+
+  if job["status"] == "failed":
+    raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=job["detail"])
+
+  if job["status"] != "done":
+    raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="The report is not ready yet")
+
+  results = await get_results(job_id, redis)
+  if results is None:
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found (or expired)")
+
+  patient_data = await run_in_threadpool(load_records, results)
+  return await run_in_threadpool(export_response, patient_data, export_format, images)
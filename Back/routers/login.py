@@ -83,14 +83,11 @@ async def logout(
 ):
   
   try:
-    # 1- Decode just to find out when this token was supposed to expire
+    # 1- Decode to get its jti + when this token was supposed to expire
     payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-    expiration = payload.get("exp")
-    await add_token_to_blacklist(token, expiration, redis)
-    
     
     # 2- Blacklist the token
-    await add_token_to_blacklist(token, expiration, redis)
+    await add_token_to_blacklist(payload, token, redis)
 
   except jwt.PyJWTError:
     pass
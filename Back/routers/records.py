@@ -0,0 +1,133 @@
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request, Response
+from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from datetime import date
+import uuid
+
+# Modules
+from Back.core.pipeline import hospital_map
+from Back.core.export import export_response, check_export, ExportFormat, ImageMode
+from Back.services.records import query_records, list_uploads, owns_sticker, record_json, stream_rows, RECORDS_MAX_LIMIT
+from Back.services.blob_store import is_blob_key
+from Back.db.models import User
+from Back.db.database import get_db
+from Back.dependencies import get_current_user
+
+router = APIRouter(
+  prefix="/records",
+  tags=["Records"]
+)
+
+class RecordFilters:
+  """
+  Query filters shared by the list and the export
+  hospital -> key from hospital_map ("amman") or its full name
+  """
+  def __init__(
+          self,
+          hospital: str | None = None,
+          payment: str | None = None,
+          admitted_from: date | None = None,
+          admitted_to: date | None = None,
+          upload_id: uuid.UUID | None = None
+  ):
+    self.hospital = hospital_map.get(hospital, hospital) if hospital else None
+    self.payment = payment
+    self.admitted_from = admitted_from
+    self.admitted_to = admitted_to
+    self.upload_id = upload_id
+
+  def as_kwargs(self):
+    return vars(self)
+
+
+@router.get("")
+async def list_records(
+        filters: RecordFilters = Depends(),
+        cursor: int | None = Query(None, description="next_cursor of the previous page"),
+        limit: int = Query(50, ge=1, le=RECORDS_MAX_LIMIT),
+        user: User = Depends(get_current_user),
+        db: AsyncSession = Depends(get_db)
+):
+  """
+  The user's extracted patients, newest first (eg. ?payment=Nathealth&admitted_from=2025-01-06)
+  pass next_cursor back as cursor for the next page, null -> last page
+  """
+  records, next_cursor = await query_records(db, user.id, **filters.as_kwargs(), cursor=cursor, limit=limit)
+  
+  return {"items": [record_json(record) for record in records], "next_cursor": next_cursor}
+
+
+@router.get("/export")
+async def export_records(
+        request: Request,
+        filters: RecordFilters = Depends(),
+        export_format: ExportFormat = Query("xlsx", alias="format"),
+        images: ImageMode = Query("none"),
+        user: User = Depends(get_current_user),
+        db: AsyncSession = Depends(get_db)
+):
+  """
+  Every record matching the filters as a report, without running the OCR again
+  the sticker images come from the blob store (xlsx or images="zip"), nothing is encoded again
+  the rows go straight from the keyset pages to the file writer (constant memory, like the live report)
+  """
+  check_export(export_format, images)
+  
+  # only read the thumbnails when they end up in the file
+  blob_store = request.app.state.blob_store if export_format == "xlsx" or images == "zip" else None
+  
+  rows = stream_rows(db, user.id, blob_store, **filters.as_kwargs())
+  return await run_in_threadpool(export_response, rows, export_format, images)
+
+
+@router.get("/stickers/{sticker_id}")
+async def get_sticker(
+        sticker_id: str,
+        request: Request,
+        user: User = Depends(get_current_user),
+        db: AsyncSession = Depends(get_db)
+):
+  """
+  One sticker thumbnail from the blob store
+  the id is the hash of the bytes, so the ETag is strong and the image never changes (304 on If-None-Match)
+  """
+  blob_store = request.app.state.blob_store
+  not_found = HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Sticker not found")
+  
+  if blob_store is None or not is_blob_key(sticker_id):
+    raise not_found
+  
+  # only the stickers of the user's own patients
+  if not await owns_sticker(db, user.id, sticker_id):
+    raise not_found
+  
+  etag = f'"{sticker_id}"'
+  headers = {"ETag": etag, "Cache-Control": "private, max-age=31536000, immutable"}
+  
+  if_none_match = request.headers.get("if-none-match", "")
+  if any(tag.strip().removeprefix("W/") in (etag, "*") for tag in if_none_match.split(",") if tag.strip()):
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+  
+  path = await run_in_threadpool(blob_store.get_path, sticker_id)
+  if path is None: # collected by the GC
+    raise not_found
+  
+  return FileResponse(path, media_type="image/png", headers=headers)
+
+
+@router.get("/uploads")
+async def my_uploads(
+        limit: int = Query(50, ge=1, le=RECORDS_MAX_LIMIT),
+        user: User = Depends(get_current_user),
+        db: AsyncSession = Depends(get_db)
+):
+  uploads = await list_uploads(db, user.id, limit)
+  
+  return [
+    {"id": str(upload.id), "created_at": upload.created_at, "source": upload.source, "images": upload.images, "patients": upload.patients}
+    for upload in uploads
+  ]
@@ -0,0 +1,65 @@
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request
+from fastapi.concurrency import run_in_threadpool
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Modules
+from Back.core.pipeline import hospital_map
+from Back.core.export import export_response, check_export, ExportFormat, ImageMode
+from Back.services.master_report import report_start, has_records, master_rows, report_info, clear_records
+from Back.db.models import User
+from Back.db.database import get_db
+from Back.dependencies import get_current_user
+
+router = APIRouter(
+  prefix="/reports",
+  tags=["Reports"]
+)
+
+@router.get("/master")
+async def download_master_report(
+        request: Request,
+        export_format: ExportFormat = Query("xlsx", alias="format"),
+        images: ImageMode = Query("none"),
+        hospital: str | None = Query(None),
+        user: User = Depends(get_current_user),
+        db: AsyncSession = Depends(get_db)
+):
+  """
+  Every patient the user uploaded since the report was last cleared, in one file
+  1- The rows come from the patient_records table (keyset pages, oldest first)
+  2- The sticker thumbnails come from the blob store (xlsx or images="zip")
+  hospital -> key from hospital_map ("amman") or its full name
+  """
+  check_export(export_format, images)
+
+  hospital_name = hospital_map.get(hospital, hospital) if hospital else None
+  start = await report_start(db, user.id)
+
+  if not await has_records(db, user.id, start, hospital_name):
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Your master report is empty")
+
+  # only read the thumbnails when they end up in the file
+  blob_store = request.app.state.blob_store if export_format == "xlsx" or images == "zip" else None
+
+  rows = master_rows(db, user.id, start, hospital_name, blob_store)
+  return await run_in_threadpool(export_response, rows, export_format, images)
+
+
+@router.get("/master/info")
+async def master_report_info(
+        user: User = Depends(get_current_user),
+        db: AsyncSession = Depends(get_db)
+):
+  return await report_info(db, user.id)
+
+
+@router.delete("/master", status_code=status.HTTP_204_NO_CONTENT)
+async def clear_master_report(
+        user: User = Depends(get_current_user),
+        db: AsyncSession = Depends(get_db)
+):
+  """
+  Starts the master report from zero (eg. a new month)
+  """
+  await clear_records(db, user.id)
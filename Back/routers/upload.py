@@ -1,118 +1,110 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Request, UploadFile, File
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Query, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from typing import List
-import numpy as np
-import cv2
-
-from PIL import Image
-import pillow_heif
-
 # Modules
-from Back.core.pipeline import process_sheet, save_data
+from Back.core.export import export_response, check_export, ExportFormat, ImageMode
+from Back.core.ingest import process_images
+from Back.core.uploads import check_upload_headers, receive_uploads, close_uploads, UPLOAD_OPENAPI
+from Back.services.records import save_records, SAVE_RECORDS
 from Back.services.rate_limiter import check_user_cooldown
 from Back.db.models import User
-from Back.db.database import get_db
-from Back.dependencies import get_current_user, check_rate_limit
+from Back.db.database import get_db, get_async_session
+from Back.dependencies import get_current_user, check_rate_limit, check_daily_limit, check_ready
 
 router = APIRouter(
   tags=["Upload"]
 )
 
 MAX_IMAGES = 5
-@router.post("/upload")
+
+async def store_patients(db, owner_id, patient_data, blob_store=None, source="upload"):
+  """
+  Saves the patients in the patient_records table and their thumbnails in the blob store
+  (a failure here doesn't fail the upload)
+  """
+  if blob_store:
+    try:
+      await run_in_threadpool(blob_store.put_many, [record.get("image_data") for record in patient_data])
+    
+    except Exception as e:
+      print(f"Failed to save the stickers of {owner_id}, Error: {e}")
+  
+  if not SAVE_RECORDS:
+    return
+  
+  try:
+    await save_records(db, owner_id, patient_data, source)
+  
+  except Exception as e:
+    await db.rollback()
+    print(f"Failed to save the patient records of {owner_id}, Error: {e}")
+
+async def save_patients(owner_id, patient_data, blob_store=None, source="upload"):
+  """
+  store_patients with its own db session, for background tasks (the request's session is closed by then)
+  """
+  async with get_async_session() as db:
+    await store_patients(db, owner_id, patient_data, blob_store, source)
+
+@router.post("/upload", openapi_extra=UPLOAD_OPENAPI)
 async def upload_sheet(
         request: Request,
+        background_tasks: BackgroundTasks,
+        ready: bool = Depends(check_ready),
         user: User = Depends(get_current_user),
         cooldown: bool = Depends(check_user_cooldown),
-        images: List[UploadFile] = File(...),
+        export_format: ExportFormat = Query("xlsx", alias="format"),
+        images: ImageMode = Query("none"),
         db: AsyncSession = Depends(get_db)
 ):
   """
   1- Check if the user is active (by the get_current_user)
-  2- Check if user is limited
-  3- Load models from state
-  4- Check if provided images do not exceed the maximum number allowed
-  5- Check if image is allowed
-  6- Process each image and store all data (Read and Decode)
-  7- Save data
+  2- Check the format, the upload headers (size, type) and if the user has requests left
+  3- Receive the images (spooled temp files, max number of images + size caps are checked while receiving)
+  4- Charge the user's daily limit, only once the whole upload was accepted
+  5- Process each image and store all data (Read, Decode, Detect, OCR)
+  6- Save the patients after the response (patient_records table + blob store, the user's master report is made from them)
+  7- Save data (xlsx report, or ndjson / csv / parquet text rows with images="zip" for the sticker thumbnails)
+  
+  note: decoding, inference and saving run off the event loop (threadpool / inference workers)
+  the "images" form field is parsed by receive_uploads, the images wait on disk and only one is decoded at a time
   """
-
-
-  if len(images) > MAX_IMAGES:
-    raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_CONTENT, detail=f"Maximum of {MAX_IMAGES} images is allowed!")
   
-  await check_rate_limit(user=user, db=db) # already handles errors
+  # 2- checks (nothing charged yet)
+  check_export(export_format, images)
+  check_upload_headers(request)
+  check_daily_limit(user)
   
-  ALLOWED_TYPES = ["image/jpeg", "image/png", "image/jpg", "image/dng", "image/heic", "image/heif"]
+  # 3- receive
+  uploads = await receive_uploads(request, max_files=MAX_IMAGES)
   
-  all_patient_data = []
+  # 4- charge
+  try:
+    await check_rate_limit(user=user, db=db) # already handles errors
   
-  hunter = request.app.state.hunter_model
-  surgeon = request.app.state.surgeon_model
-  reader = request.app.state.reader
+  except BaseException:
+    await close_uploads(uploads)
+    raise
   
-  for image in images:
-    
-    if image.content_type not in ALLOWED_TYPES and not image.filename.lower().endswith(('.heic', '.heif')):
-      # skip instead of crashing everything
-      print(f"Skipping {image.filename}: Invalid type {image.content_type}")
-      continue
-    
-    # read and decode
-    contents = await image.read()
-    image_array = None
-    
-    try:
-      is_heic = (
-              image.content_type in ["image/heic", "image/heif"] or
-              image.filename.lower().endswith(('.heic', '.heif'))
-      )
-      
-      if is_heic:
-        print(f"Processing HEIC/HEIF file: {image.filename}")
-        heif_file = pillow_heif.read_heif(contents)
-        
-        # converts the heif image to a PIL image
-        pil_image = Image.frombytes(
-          heif_file.mode,
-          heif_file.size,
-          heif_file.data,
-          "raw",
-        )
-        
-        # convert PIL image (RGB) to opencv (BGR)
-        np_image = np.array(pil_image)
-        image_array = cv2.cvtColor(np_image, cv2.COLOR_RGB2BGR)
-      
-      else:
-        # normal images processing
-        np_array = np.frombuffer(contents, np.uint8)
-        image_array = cv2.imdecode(np_array, cv2.IMREAD_COLOR)
-    
-    except Exception as e:
-      print(f"Failed to decode image {image.filename}, Error: {e}")
-      continue
-    
-    # process the image array
-    try:
-      sheet_result = process_sheet(
-        image=image_array,
-        hunter=hunter,
-        surgeon=surgeon,
-        reader=reader,
-        filename=image.filename
-      )
-      
-      all_patient_data.extend(sheet_result)
-    
-    except Exception as e:
-      print(f"Error while processing {image.filename}: {e}")
-      continue
+  # 5- process
+  inference = request.app.state.inference
+  
+  try:
+    all_patient_data = await process_images(
+      uploads,
+      inference,
+      batcher=request.app.state.hunter_batcher,
+      cache=request.app.state.result_cache
+    )
+  
+  finally:
+    await close_uploads(uploads) # the ones never reached (eg. 503), closing twice is fine
   
   if all_patient_data:
-    return save_data(all_patient_data)
+    background_tasks.add_task(save_patients, user.id, all_patient_data, request.app.state.blob_store)
+    return await run_in_threadpool(export_response, all_patient_data, export_format, images)
   
   else:
     raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="No patients found in any of the uploaded images")
\ No newline at end of file
@@ -15,6 +15,7 @@ from dotenv import load_dotenv
 # Modules
 from Back.db.models import RefreshToken
 from Back.services.redis_client import get_redis
+from Back.services.revocation_filter import revoked_tokens, REVOKED_KEY, REVOKED_CHANNEL
 
 load_dotenv()
 
@@ -47,33 +48,62 @@ def hash_token(token: str):
 def create_access_token(data: dict):
   to_encode = data.copy()
   
-  # expire time
+  # expire time + unique id (what logout revokes)
   expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-  to_encode.update({"exp": expire})
+  to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
   
   encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
   return encoded_jwt
 
-async def is_token_blacklisted(token: str, redis) -> bool:
+async def is_token_blacklisted(payload: dict, token: str, redis) -> bool:
   """
-  Returns true if the token is found in redis
+  Returns true if the token was revoked (payload is the decoded token)
+  1- Tokens from before the jti claim are still looked up by the whole token
+  2- The local filter says the jti was never revoked -> no redis call (most requests)
+  3- Filter hit (or the filter isn't synced) -> redis has the final answer
   """
-  key = f"blacklist:token:{token}"
-  return await redis.exists(key)
+  jti = payload.get("jti")
+  
+  # 1- old tokens (gone after ACCESS_TOKEN_EXPIRE_MINUTES)
+  if jti is None:
+    return await redis.exists(f"blacklist:token:{token}")
+  
+  # 2- local filter
+  if not revoked_tokens.might_be_revoked(jti):
+    return False
+  
+  # 3- redis
+  expiration = await redis.zscore(REVOKED_KEY, jti)
+  return expiration is not None and expiration > datetime.now(timezone.utc).timestamp()
 
-async def add_token_to_blacklist(token: str, expiration: float, redis):
+async def add_token_to_blacklist(payload: dict, token: str, redis):
   """
-  Adds the token to redis blacklist
-  it will delete it automatically when time expires
+  Revokes the token until it expires (payload is the decoded token)
+  its jti goes in the redis sorted set (score = expiration) and is published to the filter of every api process
   """
   
+  expiration = payload.get("exp")
   now = datetime.now(timezone.utc).timestamp()
   time_left = int(expiration - now)
   
-  if time_left > 0:
-    key = f"blacklist:token:{token}"
-    
-    await redis.set(name=key, value="blacklist", ex=time_left)
+  if time_left <= 0:
+    return
+  
+  jti = payload.get("jti")
+  
+  # old tokens
+  if jti is None:
+    await redis.set(name=f"blacklist:token:{token}", value="blacklist", ex=time_left)
+    return
+  
+  async with redis.pipeline(transaction=False) as pipe:
+    pipe.zadd(REVOKED_KEY, {jti: expiration})
+    pipe.zremrangebyscore(REVOKED_KEY, "-inf", now) # the expired ones
+    pipe.publish(REVOKED_CHANNEL, jti)
+    await pipe.execute()
+  
+  # this process doesn't wait for its own message
+  revoked_tokens.add(jti)
 
 async def create_refresh_token(user_id: uuid.UUID, db: AsyncSession):
   token = secrets.token_urlsafe(48) # random string
@@ -0,0 +1,155 @@
+import os, threading
+
+from dotenv import load_dotenv
+
+# Modules
+from Back.core.export import sticker_id
+
+load_dotenv()
+
+# "1" (default) -> the sticker thumbnails of every upload are kept in the blob store
+BLOB_STORE = os.getenv("BLOB_STORE", "1") == "1"
+
+BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR", "./data/blobs")
+
+# max total size, the least recently used blobs are deleted first (down to 90%)
+BLOB_STORE_MAX_BYTES = int(os.getenv("BLOB_STORE_MAX_BYTES", 1024 * 1024 * 1024))
+
+
+# content hash of a blob, same as the "Sticker ID" of the exports / patient_records.sticker_id
+blob_key = sticker_id
+
+def is_blob_key(key):
+  return len(key) == 32 and all(char in "0123456789abcdef" for char in key)
+
+class BlobStore:
+  """
+  Content addressed files: <folder>/ab/cd/abcd....png
+  1- Write once: a blob that already exists is never written again (same bytes -> same key), only marked as used
+  2- The file's mtime is its last use, the GC deletes the oldest ones when the store gets over max_bytes
+  """
+
+  def __init__(self, folder=BLOB_STORE_DIR, max_bytes=BLOB_STORE_MAX_BYTES, extension=".png"):
+    self.folder = folder
+    self.max_bytes = max_bytes
+    self.extension = extension
+    self.lock = threading.Lock()
+
+    os.makedirs(folder, exist_ok=True)
+    self.total = sum(size for _, size, _ in self._files())
+
+  def path(self, key):
+    # 2 levels of 256 folders, no folder gets too many files
+    return os.path.join(self.folder, key[:2], key[2:4], key + self.extension)
+
+  def _files(self):
+    """
+    (mtime, size, path) of every blob
+    """
+    for root, _, names in os.walk(self.folder):
+      for name in names:
+        if name.endswith(self.extension):
+          path = os.path.join(root, name)
+          try:
+            stat = os.stat(path)
+          except FileNotFoundError: # deleted meanwhile
+            continue
+          yield stat.st_mtime, stat.st_size, path
+
+  def put(self, data):
+    """
+    Saves the blob (if it's new) and returns its key
+    """
+    key = blob_key(data)
+    path = self.path(key)
+
+    # 1- dedup
+    if os.path.exists(path):
+      self.touch(path)
+      return key
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+      f.write(data)
+
+    # the temp file -> final name in one step, readers never see half a blob
+    os.replace(tmp, path)
+
+    with self.lock:
+      self.total += len(data)
+      over = self.total > self.max_bytes
+
+    if over:
+      self.gc()
+
+    return key
+
+  def put_many(self, blobs):
+    return [self.put(data) for data in blobs if data]
+
+  def touch(self, path):
+    try:
+      os.utime(path) # mark as recently used
+    except FileNotFoundError:
+      pass
+
+  def get_path(self, key):
+    """
+    Path of the blob, or None if it's not stored (or was collected)
+    """
+    if not is_blob_key(key):
+      return None
+
+    path = self.path(key)
+    if not os.path.exists(path):
+      return None
+
+    self.touch(path)
+    return path
+
+  def get(self, key):
+    path = self.get_path(key)
+    if path is None:
+      return None
+
+    try:
+      with open(path, "rb") as f:
+        return f.read()
+    except FileNotFoundError:
+      return None
+
+  def gc(self):
+    """
+    Deletes the least recently used blobs until the store is back under 90% of max_bytes
+    the total is counted again from the files (other processes may share the folder)
+    """
+    with self.lock:
+      files = sorted(self._files())
+      total = sum(size for _, size, _ in files)
+      target = self.max_bytes * 0.9
+
+      for _, size, path in files:
+        if total <= target:
+          break
+
+        try:
+          os.remove(path)
+        except FileNotFoundError:
+          pass
+        total -= size
+
+      self.total = total
+
+  def stats(self):
+    return {"bytes": self.total, "max_bytes": self.max_bytes}
+
+def create_blob_store():
+  """
+  Returns the blob store, or None if it's turned off
+  """
+  if not BLOB_STORE:
+    return None
+
+  return BlobStore()
\ No newline at end of file
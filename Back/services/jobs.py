@@ -0,0 +1,65 @@
+import os, uuid, json
+
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# how long a job (state + results) is kept in redis after its last update, in seconds
+JOB_TTL = int(os.getenv("JOB_TTL", 3600))
+
+
+def job_key(job_id: str):
+  return f"job:{job_id}"
+
+def results_key(job_id: str):
+  return f"job:{job_id}:results"
+
+
+async def create_job(owner_id: uuid.UUID, filenames: list, redis) -> str:
+  """
+  Saves a new queued job in redis and returns its id
+  """
+  job_id = uuid.uuid4().hex
+  
+  job = {
+    "id": job_id,
+    "owner": str(owner_id),
+    "status": "queued", # queued -> running -> done / failed
+    "detail": None,
+    "created_at": datetime.now(timezone.utc).isoformat(),
+    "patients": 0,
+    "images": [{"filename": name, "status": "queued", "patients": 0} for name in filenames]
+  }
+  
+  await redis.set(job_key(job_id), json.dumps(job), ex=JOB_TTL)
+  return job_id
+
+async def get_job(job_id: str, redis) -> dict | None:
+  raw = await redis.get(job_key(job_id))
+  return json.loads(raw) if raw else None
+
+async def update_job(job_id: str, redis, image_index: int | None = None, **changes):
+  """
+  Updates the job fields (or one image's fields if image_index is given)
+  the TTL starts again on every update
+  """
+  job = await get_job(job_id, redis)
+  if job is None: # expired
+    return
+  
+  if image_index is None:
+    job.update(changes)
+  else:
+    job["images"][image_index].update(changes)
+  
+  await redis.set(job_key(job_id), json.dumps(job), ex=JOB_TTL)
+
+async def save_results(job_id: str, results: bytes, redis):
+  """
+  results -> the patient rows (dump_records), every export format is made from them on download
+  """
+  await redis.set(results_key(job_id), results, ex=JOB_TTL)
+
+async def get_results(job_id: str, redis) -> bytes | None:
+  return await redis.get(results_key(job_id))
\ No newline at end of file
@@ -0,0 +1,66 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, func
+
+from datetime import datetime, timezone
+import uuid
+
+# Modules
+from Back.db.models import PatientRecord, MasterReport
+from Back.services.records import stream_rows
+
+# the master report is made from the patient_records table (SAVE_RECORDS) + the thumbnails in the blob store
+# nothing is kept per replica, every api process builds the same report
+
+
+def record_filter(owner_id: uuid.UUID, start: int, hospital: str | None = None):
+  conditions = [PatientRecord.owner_id == owner_id, PatientRecord.id > start]
+  if hospital:
+    conditions.append(PatientRecord.hospital == hospital)
+
+  return conditions
+
+async def report_start(db: AsyncSession, owner_id: uuid.UUID) -> int:
+  """
+  Last patient_records id before the user cleared the report (0 -> never cleared)
+  """
+  result = await db.execute(select(MasterReport.starts_after).where(MasterReport.owner_id == owner_id))
+  return result.scalar() or 0
+
+async def has_records(db: AsyncSession, owner_id: uuid.UUID, start: int, hospital: str | None = None) -> bool:
+  result = await db.execute(select(PatientRecord.id).where(*record_filter(owner_id, start, hospital)).limit(1))
+  return result.first() is not None
+
+def master_rows(db: AsyncSession, owner_id: uuid.UUID, start: int, hospital: str | None = None, blob_store=None):
+  """
+  Report rows of the master report in the order they were added (generator, runs in the export's thread)
+  hospital -> full hospital name (see hospital_map)
+  blob_store -> the sticker thumbnails are read from it
+  """
+  return stream_rows(db, owner_id, blob_store, cursor=start, oldest_first=True, hospital=hospital)
+
+async def report_info(db: AsyncSession, owner_id: uuid.UUID):
+  """
+  Number of patients in the user's master report + when it was last cleared
+  """
+  report = await db.get(MasterReport, owner_id)
+  start = report.starts_after if report else 0
+
+  patients = await db.scalar(select(func.count()).select_from(PatientRecord).where(*record_filter(owner_id, start)))
+  return {"patients": patients, "cleared_at": report.cleared_at if report else None}
+
+async def clear_records(db: AsyncSession, owner_id: uuid.UUID):
+  """
+  Starts the user's master report from zero (eg. a new month)
+  the patient records are kept (GET /records), the report only starts after the current last one
+  """
+  last_id = await db.scalar(select(func.max(PatientRecord.id)).where(PatientRecord.owner_id == owner_id))
+  now = datetime.now(timezone.utc).replace(tzinfo=None)
+
+  report = await db.get(MasterReport, owner_id)
+  if report is None:
+    db.add(MasterReport(owner_id=owner_id, starts_after=last_id or 0, cleared_at=now))
+  else:
+    report.starts_after = last_id or 0
+    report.cleared_at = now
+
+  await db.commit()
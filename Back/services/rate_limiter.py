@@ -13,6 +13,9 @@ async def check_user_cooldown(
 ):
   """
   To prevent spamming for 10 seconds after a request
+  
+  note: the route also depends on get_current_user, fastapi caches a dependency per request
+  so the user is only loaded once (don't add use_cache=False here)
   """
   
   key = f"cooldown:user:{user.id}"
@@ -0,0 +1,173 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, insert
+
+from anyio import from_thread
+from functools import partial
+from datetime import datetime, date
+import uuid
+import os
+
+# Modules
+from Back.db.models import Upload, PatientRecord
+from Back.core.export import sticker_id
+from Back.core.report import excel_structure
+
+# "1" (default) -> the patients of every upload / job are saved in the patient_records table
+SAVE_RECORDS = os.getenv("SAVE_RECORDS", "1") == "1"
+
+# max page size of GET /records
+RECORDS_MAX_LIMIT = 200
+
+# longest value kept per column (hospital / payment are in btree indexes, postgres caps an index entry at ~2.7KB)
+FIELD_MAX_CHARS = 512
+
+# report column -> PatientRecord column
+COLUMNS = {
+  "المريض": "name",
+  "تاريخ الدخول": "admission_date_text",
+  "Age": "age",
+  "المستشفى": "hospital",
+  "Payment": "payment",
+  "File Name": "file_name",
+}
+
+
+def parse_date(text):
+  """
+  "YYYY/MM/DD" (see standardize_date) -> date, None for anything else
+  """
+  try:
+    return datetime.strptime(text.strip(), "%Y/%m/%d").date()
+  except (AttributeError, ValueError):
+    return None
+
+async def save_records(db: AsyncSession, owner_id: uuid.UUID, patient_data: list, source: str = "upload") -> uuid.UUID:
+  """
+  Saves one upload and all its patients
+  1- Upload row (the batch)
+  2- One bulk INSERT for all the patients (executemany, no ORM objects)
+  Returns the upload id
+  """
+  # 1- batch
+  images = len({record.get("File Name") for record in patient_data})
+  upload = Upload(owner_id=owner_id, source=source, images=images, patients=len(patient_data))
+  db.add(upload)
+  await db.flush()
+
+  # 2- patients
+  rows = []
+  for record in patient_data:
+    row = {column: str(record.get(key, "-"))[:FIELD_MAX_CHARS] for key, column in COLUMNS.items()}
+    row["admission_date"] = parse_date(row["admission_date_text"])
+    row["sticker_id"] = sticker_id(record.get("image_data"))
+    row["upload_id"] = upload.id
+    row["owner_id"] = owner_id
+    rows.append(row)
+
+  if rows:
+    await db.execute(insert(PatientRecord), rows)
+
+  await db.commit()
+  return upload.id
+
+async def query_records(
+        db: AsyncSession,
+        owner_id: uuid.UUID,
+        hospital: str | None = None,
+        payment: str | None = None,
+        admitted_from: date | None = None,
+        admitted_to: date | None = None,
+        upload_id: uuid.UUID | None = None,
+        cursor: int | None = None,
+        limit: int = 50,
+        oldest_first: bool = False
+):
+  """
+  One page of the owner's patients, newest first (oldest_first -> in the order they were saved)
+  keyset pagination: cursor is the last id of the previous page (no OFFSET, every page costs the same)
+  Returns (records, next cursor or None)
+  """
+  query = select(PatientRecord).where(PatientRecord.owner_id == owner_id)
+
+  if hospital:
+    query = query.where(PatientRecord.hospital == hospital)
+  if payment:
+    query = query.where(PatientRecord.payment == payment)
+  if admitted_from:
+    query = query.where(PatientRecord.admission_date >= admitted_from)
+  if admitted_to:
+    query = query.where(PatientRecord.admission_date <= admitted_to)
+  if upload_id:
+    query = query.where(PatientRecord.upload_id == upload_id)
+  if cursor and oldest_first:
+    query = query.where(PatientRecord.id > cursor)
+  elif cursor:
+    query = query.where(PatientRecord.id < cursor)
+
+  order = PatientRecord.id.asc() if oldest_first else PatientRecord.id.desc()
+
+  # one more row to know if there is a next page
+  result = await db.execute(query.order_by(order).limit(limit + 1))
+  records = list(result.scalars().all())
+
+  next_cursor = None
+  if len(records) > limit:
+    records = records[:limit]
+    next_cursor = records[-1].id
+
+  return records, next_cursor
+
+async def list_uploads(db: AsyncSession, owner_id: uuid.UUID, limit: int = 50):
+  result = await db.execute(
+    select(Upload).where(Upload.owner_id == owner_id).order_by(Upload.created_at.desc()).limit(limit)
+  )
+  return list(result.scalars().all())
+
+def record_json(record: PatientRecord):
+  return {
+    "id": record.id,
+    "upload_id": str(record.upload_id),
+    "name": record.name,
+    "admission_date": record.admission_date_text,
+    "age": record.age,
+    "hospital": record.hospital,
+    "payment": record.payment,
+    "file_name": record.file_name,
+    "sticker_id": record.sticker_id,
+    "created_at": record.created_at,
+  }
+
+def record_row(record: PatientRecord, blob_store=None):
+  """
+  Back to the report row format (for the exports), same "-" as the live report for the columns that aren't stored
+  blob_store -> the thumbnail is read from it (None if it was never stored or was collected)
+  """
+  row = {col: "-" for col, _ in excel_structure}
+  row["Sticker image"] = "" # or the text shows behind the image
+
+  row.update({key: getattr(record, column) for key, column in COLUMNS.items()})
+  row["Sticker ID"] = record.sticker_id
+  row["image_data"] = blob_store.get(record.sticker_id) if blob_store and record.sticker_id else None
+  return row
+
+def stream_rows(db: AsyncSession, owner_id: uuid.UUID, blob_store=None, cursor: int | None = None, oldest_first: bool = False, **filters):
+  """
+  Report rows of every matching record, one keyset page at a time (only one page + its thumbnails in memory)
+  runs in the export's worker thread (run_in_threadpool), the queries are sent back to the event loop
+  """
+  while True:
+    records, cursor = from_thread.run(partial(
+      query_records, db, owner_id, **filters, cursor=cursor, limit=RECORDS_MAX_LIMIT, oldest_first=oldest_first
+    ))
+
+    for record in records:
+      yield record_row(record, blob_store)
+
+    if cursor is None:
+      break
+
+async def owns_sticker(db: AsyncSession, owner_id: uuid.UUID, sticker_id: str) -> bool:
+  result = await db.execute(
+    select(PatientRecord.id).where(PatientRecord.owner_id == owner_id, PatientRecord.sticker_id == sticker_id).limit(1)
+  )
+  return result.first() is not None
\ No newline at end of file
@@ -30,4 +30,11 @@ async def get_redis():
     yield client
   
   finally:
-    await client.close()
\ No newline at end of file
+    await client.close()
+
+def get_redis_client():
+  """
+  Same as get_redis but for code that runs outside a request (background tasks)
+  remember to close it
+  """
+  return redis.Redis(connection_pool=redis_pool)
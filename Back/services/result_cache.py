@@ -0,0 +1,265 @@
+from fastapi.concurrency import run_in_threadpool
+
+import os, json, time
+import hashlib, base64
+
+from dotenv import load_dotenv
+
+# Modules
+from Back.core.pipeline import HUNTER_MODEL_PATH, SURGEON_MODEL_PATH, HUNTER_MAX_SIDE, OCR_SKIP_DETECTOR, OCR_TIERS, THUMBNAIL_HEIGHT
+from Back.services.redis_client import get_redis_client
+
+load_dotenv()
+
+# "off" (default) | "redis" | "disk"
+RESULT_CACHE = os.getenv("RESULT_CACHE", "off")
+
+# max total size of the cached results, the least recently used ones are evicted first
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+# only used by the disk cache
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "./cache/results")
+
+
+""" KEYS """
+
+_model_versions = {} # loaded backend -> version
+
+def file_digest(path):
+  """
+  Hash of a weights file (or "missing")
+  """
+  if not os.path.exists(path):
+    return "missing"
+
+  digest = hashlib.blake2b(digest_size=16)
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+      digest.update(chunk)
+
+  return digest.hexdigest()
+
+def model_version(backend):
+  """
+  Everything that changes the output of process_sheet (computed once per backend)
+  backend -> what the models really run on (inference.backend), not the requested INFERENCE_BACKEND
+  since a failed export or self-check falls back to pytorch
+  """
+  if backend not in _model_versions:
+    parts = [
+      file_digest(HUNTER_MODEL_PATH), file_digest(SURGEON_MODEL_PATH), str(backend),
+      f"hunter{HUNTER_MAX_SIDE}", str(OCR_SKIP_DETECTOR), ",".join(OCR_TIERS), f"thumbnail{THUMBNAIL_HEIGHT}"
+    ]
+    _model_versions[backend] = hashlib.blake2b("|".join(parts).encode(), digest_size=8).hexdigest()
+
+  return _model_versions[backend]
+
+def image_key(image, backend):
+  """
+  Content hash of the decoded image + the model version
+  """
+  digest = hashlib.blake2b(digest_size=20)
+  digest.update(str(image.shape).encode())
+  digest.update(memoryview(image) if image.flags.c_contiguous else image.tobytes()) # memoryview -> no copy
+
+  return f"{model_version(backend)}:{digest.hexdigest()}"
+
+
+""" SERIALIZATION (json, sticker bytes as base64) """
+
+def dump_records(records):
+  rows = []
+  for record in records:
+    row = dict(record)
+    if row.get("image_data"):
+      row["image_data"] = base64.b64encode(row["image_data"]).decode("ascii")
+    rows.append(row)
+
+  return json.dumps(rows, ensure_ascii=False).encode("utf-8")
+
+def load_records(raw):
+  rows = json.loads(raw)
+  for row in rows:
+    if row.get("image_data"):
+      row["image_data"] = base64.b64decode(row["image_data"])
+
+  return rows
+
+
+""" BACKENDS """
+
+class DiskStore:
+  """
+  One file per result, the file's mtime is its last use (LRU)
+  """
+
+  def __init__(self, folder=RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES):
+    self.folder = folder
+    self.max_bytes = max_bytes
+    os.makedirs(folder, exist_ok=True)
+
+  def path(self, key):
+    return os.path.join(self.folder, key.replace(":", "_") + ".json")
+
+  def _get(self, key):
+    path = self.path(key)
+
+    try:
+      with open(path, "rb") as f:
+        raw = f.read()
+    except FileNotFoundError:
+      return None
+
+    os.utime(path) # mark as recently used
+    return raw
+
+  def _put(self, key, raw):
+    path = self.path(key)
+    tmp = path + ".tmp"
+
+    with open(tmp, "wb") as f:
+      f.write(raw)
+    os.replace(tmp, path)
+
+    self._evict()
+
+  def _evict(self):
+    """
+    Deletes the least recently used files until the folder fits in max_bytes
+    """
+    files = []
+    total = 0
+
+    for entry in os.scandir(self.folder):
+      if entry.name.endswith(".json"):
+        stat = entry.stat()
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+        total += stat.st_size
+
+    files.sort()
+    for _, size, path in files:
+      if total <= self.max_bytes:
+        break
+
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+      total -= size
+
+  async def get(self, key):
+    return await run_in_threadpool(self._get, key)
+
+  async def put(self, key, raw):
+    await run_in_threadpool(self._put, key, raw)
+
+class RedisStore:
+  """
+  result:{key} -> data, a sorted set keeps the last use of every key (LRU)
+  and a counter keeps the total size
+  """
+
+  LRU_KEY = "result_cache:lru"
+  SIZE_KEY = "result_cache:bytes"
+
+  # set + size update + eviction in one script, so replicas putting at the same time can't skew the counter
+  # KEYS -> result key, LRU_KEY, SIZE_KEY / ARGV -> data, now, max bytes, cache key
+  PUT_SCRIPT = """
+  local old_size = redis.call("STRLEN", KEYS[1])
+  redis.call("SET", KEYS[1], ARGV[1])
+  redis.call("ZADD", KEYS[2], ARGV[2], ARGV[4])
+  local total = redis.call("INCRBY", KEYS[3], string.len(ARGV[1]) - old_size)
+
+  while total > tonumber(ARGV[3]) do
+    local oldest = redis.call("ZPOPMIN", KEYS[2])
+    if #oldest == 0 then break end
+
+    local result_key = "result:" .. oldest[1]
+    total = redis.call("DECRBY", KEYS[3], redis.call("STRLEN", result_key))
+    redis.call("DEL", result_key)
+  end
+
+  return total
+  """
+
+  def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES):
+    self.max_bytes = max_bytes
+    self.redis = get_redis_client()
+    self.put_script = self.redis.register_script(self.PUT_SCRIPT)
+
+  async def get(self, key):
+    raw = await self.redis.get(f"result:{key}")
+
+    if raw is not None:
+      await self.redis.zadd(self.LRU_KEY, {key: time.time()})
+
+    return raw
+
+  async def put(self, key, raw):
+    # note: the evicted keys are not in KEYS, fine on a single redis (not on redis cluster)
+    await self.put_script(
+      keys=[f"result:{key}", self.LRU_KEY, self.SIZE_KEY],
+      args=[raw, time.time(), self.max_bytes, key]
+    )
+
+
+""" CACHE """
+
+class ResultCache:
+  """
+  process_sheet results (patients + sticker png bytes) by image content
+  a hit skips the whole inference
+  """
+
+  def __init__(self, store):
+    self.store = store
+    self.hits = 0
+    self.misses = 0
+
+  async def get(self, key, filename):
+    try:
+      raw = await self.store.get(key)
+    except Exception as e: # the cache should never break an upload
+      print(f"Failed to read cached result, Error: {e}")
+      raw = None
+
+    if raw is None:
+      self.misses += 1
+      return None
+
+    self.hits += 1
+    records = await run_in_threadpool(load_records, raw)
+
+    # the same photo can come back with another name
+    for record in records:
+      record["File Name"] = filename
+
+    return records
+
+  async def put(self, key, records):
+    try:
+      await self.store.put(key, await run_in_threadpool(dump_records, records))
+    except Exception as e: # the cache should never break an upload
+      print(f"Failed to cache result, Error: {e}")
+
+  def stats(self):
+    total = self.hits + self.misses
+
+    return {
+      "backend": RESULT_CACHE,
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_rate": self.hits / total if total else 0.0
+    }
+
+def create_result_cache():
+  """
+  Returns the cache, or None if it's turned off
+  """
+  if RESULT_CACHE == "redis":
+    return ResultCache(RedisStore())
+
+  if RESULT_CACHE == "disk":
+    return ResultCache(DiskStore())
+
+  return None
@@ -0,0 +1,167 @@
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+import hashlib
+import asyncio
+import math
+import time
+import os
+
+# Modules
+from Back.services.redis_client import get_redis_client
+
+load_dotenv()
+
+# "1" (default) -> every api process keeps a bloom filter of the revoked jtis, redis is only asked on a filter hit
+REVOKED_FILTER = os.getenv("REVOKED_FILTER", "1") == "1"
+
+# revoked tokens the filter is sized for (it's rebuilt bigger if there are more) + its false positive rate
+REVOKED_FILTER_CAPACITY = int(os.getenv("REVOKED_FILTER_CAPACITY", 100_000))
+REVOKED_FILTER_ERROR_RATE = float(os.getenv("REVOKED_FILTER_ERROR_RATE", 0.001))
+
+# seconds between two rebuilds from the redis snapshot (drops the expired jtis, a bloom filter can't delete)
+REVOKED_SNAPSHOT_SECONDS = float(os.getenv("REVOKED_SNAPSHOT_SECONDS", 300))
+
+# sorted set of the revoked jtis, score = expiration of the token (unix seconds)
+REVOKED_KEY = "blacklist:jtis"
+
+# every api process listens here, the message is a revoked jti
+REVOKED_CHANNEL = "blacklist:revoked"
+
+# seconds before subscribing again after the redis connection dropped
+RESUBSCRIBE_DELAY = 5
+
+
+class BloomFilter:
+  """
+  Fixed size bit array, k bit positions per item (double hashing of one blake2b digest)
+  no false negatives: an item that was added is always found
+  """
+
+  def __init__(self, capacity=REVOKED_FILTER_CAPACITY, error_rate=REVOKED_FILTER_ERROR_RATE):
+    capacity = max(1, capacity)
+
+    # optimal sizes: m = -n ln(p) / ln(2)^2 bits, k = m / n ln(2) hashes
+    self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    self.hashes = max(1, round(self.size / capacity * math.log(2)))
+    self.bits = bytearray((self.size + 7) // 8)
+    self.count = 0
+
+  def positions(self, item):
+    digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+    first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+    return ((first + i * second) % self.size for i in range(self.hashes))
+
+  def add(self, item):
+    for position in self.positions(item):
+      self.bits[position >> 3] |= 1 << (position & 7)
+    self.count += 1
+
+  def __contains__(self, item):
+    return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+
+
+class RevokedTokens:
+  """
+  Local copy of the revoked jtis of this api process
+  1- Loaded from the redis sorted set (snapshot) right after subscribing, so no revocation is missed in between
+  2- Every revocation published after that is added as it comes
+  3- Rebuilt from the snapshot every REVOKED_SNAPSHOT_SECONDS
+  Until it's synced (or when the channel drops) every check goes to redis
+  """
+
+  def __init__(self):
+    self.filter = None
+    self.ready = False
+    self.redis_checks = 0
+    self.skipped_checks = 0
+
+  def might_be_revoked(self, jti):
+    if not self.ready:
+      return True
+
+    if jti in self.filter:
+      self.redis_checks += 1
+      return True
+
+    self.skipped_checks += 1
+    return False
+
+  def add(self, jti):
+    if self.filter is not None:
+      self.filter.add(jti)
+
+  def stats(self):
+    return {
+      "ready": self.ready,
+      "revoked": self.filter.count if self.filter else 0,
+      "redis_checks": self.redis_checks,
+      "skipped_checks": self.skipped_checks,
+    }
+
+revoked_tokens = RevokedTokens()
+
+
+async def load_snapshot(redis):
+  """
+  New filter from the live jtis in redis (the expired ones are removed first), then swapped in
+  """
+  now = datetime.now(timezone.utc).timestamp()
+  await redis.zremrangebyscore(REVOKED_KEY, "-inf", now)
+
+  # room to grow until the next rebuild
+  live = await redis.zcard(REVOKED_KEY)
+  new_filter = BloomFilter(max(REVOKED_FILTER_CAPACITY, live * 2))
+
+  async for jti, _ in redis.zscan_iter(REVOKED_KEY, count=1000):
+    new_filter.add(jti.decode("utf-8"))
+
+  revoked_tokens.filter = new_filter
+
+async def sync_revoked_tokens():
+  """
+  Runs for the lifetime of the app (lifespan task)
+  subscribe -> snapshot -> apply the published jtis (+ a new snapshot every REVOKED_SNAPSHOT_SECONDS)
+  messages that come while a snapshot is loading wait in the subscription and are applied after it
+  """
+  if not REVOKED_FILTER:
+    return
+
+  while True:
+    redis = get_redis_client()
+    pubsub = redis.pubsub()
+
+    try:
+      # 1- subscribe before the snapshot, a revocation in between is in both (adding twice is harmless)
+      await pubsub.subscribe(REVOKED_CHANNEL)
+      await load_snapshot(redis)
+      revoked_tokens.ready = True
+      next_snapshot = time.monotonic() + REVOKED_SNAPSHOT_SECONDS
+
+      while True:
+        # 2- published revocations
+        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+        if message and message["type"] == "message":
+          revoked_tokens.add(message["data"].decode("utf-8"))
+
+        # 3- periodic rebuild
+        if time.monotonic() >= next_snapshot:
+          await load_snapshot(redis)
+          next_snapshot = time.monotonic() + REVOKED_SNAPSHOT_SECONDS
+
+    except asyncio.CancelledError:
+      raise
+
+    except Exception as e:
+      print(f"Revoked tokens filter lost its sync with redis, Error: {e}")
+
+    finally:
+      revoked_tokens.ready = False
+
+      try:
+        await pubsub.aclose()
+        await redis.close()
+      except Exception:
+        pass
+
+    await asyncio.sleep(RESUBSCRIBE_DELAY)
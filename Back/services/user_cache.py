@@ -0,0 +1,188 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy import select, inspect
+
+from collections import OrderedDict
+from dotenv import load_dotenv
+import asyncio
+import time
+import os
+
+# Modules
+from Back.db.models import User
+from Back.services.redis_client import get_redis_client
+
+load_dotenv()
+
+# "1" (default) -> get_current_user reads the user rows from an in process cache instead of the db
+USER_CACHE = os.getenv("USER_CACHE", "1") == "1"
+
+# seconds a cached row is trusted even if no invalidation came (safety net for lost messages)
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 60))
+
+# max users kept per api process, the least recently used one is dropped first
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 1024))
+
+# every api process listens here, the message is a username or "*" (drop everything)
+USER_CACHE_CHANNEL = "user_cache:invalidate"
+
+# seconds before subscribing again after the redis connection dropped
+RESUBSCRIBE_DELAY = 5
+
+# mapped attribute names of the users table
+USER_COLUMNS = [attr.key for attr in inspect(User).column_attrs]
+
+
+class UserCache:
+  """
+  TTL + LRU cache of user rows, keyed by username
+  1- Values are plain column snapshots, never the ORM objects of another request's session
+  2- Only used while subscribed to the invalidation channel (a process that can't hear invalidations goes to the db)
+  3- generation is bumped on every invalidation, a row loaded before an invalidation is not cached
+  """
+
+  def __init__(self, ttl=USER_CACHE_TTL, max_size=USER_CACHE_SIZE):
+    self.ttl = ttl
+    self.max_size = max_size
+    self.entries = OrderedDict() # username -> (expires at, columns)
+    self.generation = 0
+    self.listening = False
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, username):
+    if not self.listening:
+      return None
+
+    entry = self.entries.get(username)
+    if entry is None or entry[0] < time.monotonic():
+      self.entries.pop(username, None)
+      self.misses += 1
+      return None
+
+    self.entries.move_to_end(username)
+    self.hits += 1
+    return entry[1]
+
+  def put(self, username, columns, generation):
+    # invalidated while the row was being loaded -> it may already be outdated
+    if not self.listening or generation != self.generation:
+      return
+
+    self.entries[username] = (time.monotonic() + self.ttl, columns)
+    self.entries.move_to_end(username)
+
+    while len(self.entries) > self.max_size:
+      self.entries.popitem(last=False)
+
+  def invalidate(self, username=None):
+    """
+    Drops one user, or everyone when username is None
+    """
+    self.generation += 1
+
+    if username is None:
+      self.entries.clear()
+    else:
+      self.entries.pop(username, None)
+
+  def stats(self):
+    return {"users": len(self.entries), "hits": self.hits, "misses": self.misses, "listening": self.listening}
+
+user_cache = UserCache() if USER_CACHE else None
+
+
+def snapshot(user: User):
+  return {key: getattr(user, key) for key in USER_COLUMNS}
+
+async def load_user(username: str, db: AsyncSession):
+  """
+  The user for this request, attached to db (check_rate_limit can still update it)
+  1- Cache hit -> a copy of the cached row is merged into the session without a SELECT
+  2- Miss -> SELECT, then the row is cached for the next requests
+  Returns None if there is no such user
+  """
+  if user_cache is None:
+    result = await db.execute(select(User).where(User.username == username))
+    return result.scalars().first()
+
+  # 1- hit
+  columns = user_cache.get(username)
+  if columns is not None:
+    user = User(**columns)
+    make_transient_to_detached(user)
+    return await db.merge(user, load=False)
+
+  # 2- miss
+  generation = user_cache.generation
+  result = await db.execute(select(User).where(User.username == username))
+  user = result.scalars().first()
+
+  if user is not None:
+    user_cache.put(username, snapshot(user), generation)
+
+  return user
+
+async def invalidate_user(username: str | None = None):
+  """
+  Drops the user from the cache of this process right away and from every other api process through redis
+  username None -> drops all the users (eg. an admin edit that may have renamed someone)
+  """
+  if user_cache is None:
+    return
+
+  user_cache.invalidate(username)
+
+  redis = get_redis_client()
+  try:
+    await redis.publish(USER_CACHE_CHANNEL, username or "*")
+
+  except Exception as e:
+    # the other processes still drop it after USER_CACHE_TTL
+    print(f"Failed to publish the user cache invalidation, Error: {e}")
+
+  finally:
+    await redis.close()
+
+async def listen_for_invalidations():
+  """
+  Runs for the lifetime of the app (lifespan task)
+  the cache is only used while subscribed, and it starts empty after every (re)subscribe
+  because the messages sent while disconnected are lost
+  """
+  if user_cache is None:
+    return
+
+  while True:
+    redis = get_redis_client()
+    pubsub = redis.pubsub()
+
+    try:
+      await pubsub.subscribe(USER_CACHE_CHANNEL)
+      user_cache.invalidate()
+      user_cache.listening = True
+
+      async for message in pubsub.listen():
+        if message["type"] != "message":
+          continue
+
+        username = message["data"].decode("utf-8")
+        user_cache.invalidate(None if username == "*" else username)
+
+    except asyncio.CancelledError:
+      raise
+
+    except Exception as e:
+      print(f"User cache lost its invalidation channel, Error: {e}")
+
+    finally:
+      user_cache.listening = False
+      user_cache.invalidate()
+
+      try:
+        await pubsub.aclose()
+        await redis.close()
+      except Exception:
+        pass
+
+    await asyncio.sleep(RESUBSCRIBE_DELAY)
@@ -0,0 +1,86 @@
+"""
+Decode benchmark: old upload decoding vs Back/core/decode.py, latency + peak RSS per format
+
+usage (from the repo root):
+  python -m benchmarks.bench_decode photo.jpg photo.heic sheet.png [--max-side 2048] [--rounds 5]
+
+every (file, method) runs in a fresh process so the peak RSS of one doesn't hide the other
+"""
+from multiprocessing import get_context
+import argparse
+import resource
+import time
+import os
+
+def legacy_decode(contents, filename):
+  """
+  /upload decoding before the decode module
+  """
+  import numpy as np
+  import cv2
+  from PIL import Image
+  import pillow_heif
+
+  if filename.lower().endswith(('.heic', '.heif')):
+    heif_file = pillow_heif.read_heif(contents)
+    pil_image = Image.frombytes(heif_file.mode, heif_file.size, heif_file.data, "raw")
+    np_image = np.array(pil_image)
+    return cv2.cvtColor(np_image, cv2.COLOR_RGB2BGR)
+
+  np_array = np.frombuffer(contents, np.uint8)
+  return cv2.imdecode(np_array, cv2.IMREAD_COLOR)
+
+def run_case(path, method, max_side, rounds):
+  """
+  Runs inside the child process, returns (ms per decode, peak RSS growth in MB, output shape)
+  """
+  # imports first so they don't count in the decode memory
+  from Back.core.decode import decode_image
+
+  with open(path, "rb") as f:
+    contents = f.read()
+
+  filename = os.path.basename(path)
+  content_type = "image/heic" if filename.lower().endswith(('.heic', '.heif')) else ""
+
+  baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  start = time.perf_counter()
+
+  for _ in range(rounds):
+    if method == "legacy":
+      image = legacy_decode(contents, filename)
+    else:
+      image = decode_image(contents, filename, content_type, max_side=max_side)
+
+    shape = image.shape
+    del image
+
+  elapsed = (time.perf_counter() - start) / rounds * 1000
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline # KB on linux
+
+  return elapsed, peak / 1024, shape
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("files", nargs="+")
+  parser.add_argument("--max-side", type=int, default=0)
+  parser.add_argument("--rounds", type=int, default=5)
+  args = parser.parse_args()
+
+  ctx = get_context("spawn")
+  cases = [("legacy", 0), ("decode", 0)]
+  if args.max_side:
+    cases.append(("decode", args.max_side))
+
+  print(f"{'file':<24} {'method':<14} {'ms':>8} {'peak MB':>9}  shape")
+
+  for path in args.files:
+    for method, max_side in cases:
+      with ctx.Pool(1) as pool:
+        ms, peak_mb, shape = pool.apply(run_case, (path, method, max_side, args.rounds))
+
+      label = method if not max_side else f"{method}@{max_side}"
+      print(f"{os.path.basename(path):<24} {label:<14} {ms:8.1f} {peak_mb:9.1f}  {shape}")
+
+if __name__ == '__main__':
+  main()
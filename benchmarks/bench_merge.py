@@ -0,0 +1,169 @@
+"""
+Merge benchmark: old /tools/merge (openpyxl full mode + deepcopy) vs Back/core/merge.py, time + peak RSS
+
+usage (from the repo root):
+  python -m benchmarks.bench_merge [--reports 20] [--rows 200] [--workers 4]
+
+the reports are made with the real report writer (one random 125px sticker per row)
+every method runs in a fresh process so the peak RSS of one doesn't hide the other
+"""
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from tempfile import TemporaryDirectory
+import argparse
+import resource
+import io
+import zipfile
+import time
+import os
+
+def make_reports(folder, reports, rows):
+  """
+  Writes the test reports, every sticker is different (no dedup help)
+  """
+  from PIL import Image
+  from Back.core.report import write_report
+
+  paths = []
+  for report_index in range(reports):
+    patients = []
+    for row in range(rows):
+      sticker = io.BytesIO()
+      Image.effect_noise((240, 125), 64).convert("RGB").save(sticker, format="PNG")
+
+      patients.append({
+        "المريض": f"Patient {report_index}-{row}",
+        "تاريخ الدخول": "2025/01/15",
+        "Age": "42",
+        "المستشفى": "مستشفى عمان الجراحي",
+        "Payment": "Nathealth",
+        "File Name": f"sheet_{report_index}.jpg",
+        "image_data": sticker.getvalue(),
+      })
+
+    path = os.path.join(folder, f"report_{report_index}.xlsx")
+    with open(path, "wb") as f, TemporaryDirectory() as tmpdir:
+      write_report(patients, f, tmpdir)
+
+    paths.append(path)
+
+  return paths
+
+def legacy_merge(paths):
+  """
+  /tools/merge before the merge engine (same steps, without fastapi)
+  """
+  from copy import copy, deepcopy
+  import openpyxl
+
+  merged_wb = openpyxl.Workbook()
+  merged_ws = merged_wb.active
+  merged_ws.title = "Merged_Patients"
+  merged_ws.sheet_view.rightToLeft = True
+
+  current_row_offset = 1
+  headers_set = False
+
+  for path in paths:
+    with open(path, "rb") as f:
+      content = f.read()
+
+    source_wb = openpyxl.load_workbook(filename=io.BytesIO(content))
+    source_ws = source_wb.active
+
+    if not headers_set:
+      for col_index, cell in enumerate(source_ws[1], 1):
+        new_cell = merged_ws.cell(row=1, column=col_index, value=cell.value)
+        if cell.has_style:
+          new_cell.font = copy(cell.font)
+          new_cell.border = copy(cell.border)
+          new_cell.fill = copy(cell.fill)
+
+      for col_letter, col_dim in source_ws.column_dimensions.items():
+        merged_ws.column_dimensions[col_letter].width = col_dim.width
+
+      headers_set = True
+
+    rows = list(source_ws.rows)
+    num_rows = len(rows)
+
+    if num_rows > 1:
+      for row_index, row in enumerate(rows[1:], 1):
+        target_row_index = current_row_offset + row_index
+        for col_index, cell in enumerate(row, 1):
+          merged_ws.cell(row=target_row_index, column=col_index, value=cell.value)
+        merged_ws.row_dimensions[target_row_index].height = source_ws.row_dimensions[row_index + 1].height
+
+    if hasattr(source_ws, '_images'):
+      for image in source_ws._images:
+        anchor_row = image.anchor._from.row + 1
+        if anchor_row > 1:
+          new_anchor_row = current_row_offset + (anchor_row - 1)
+          new_img = deepcopy(image)
+          new_img.anchor._from.row = new_anchor_row - 1
+          height_in_rows = image.anchor.to.row - image.anchor._from.row
+          new_img.anchor.to.row = new_anchor_row - 1 + height_in_rows
+          merged_ws.add_image(new_img)
+
+    current_row_offset += (num_rows - 1)
+
+  output = io.BytesIO()
+  merged_wb.save(output)
+  return output.getvalue()
+
+def run_case(paths, method, workers):
+  """
+  Runs inside the child process, returns (seconds, peak RSS growth in MB, output MB, images in the output)
+  """
+  from Back.core.merge import merge_reports, create_merge_pool
+  import openpyxl # imported before the baseline for both methods
+
+  baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  start = time.perf_counter()
+
+  if method == "legacy":
+    data = legacy_merge(paths)
+  else:
+    pool = create_merge_pool(workers)
+    try:
+      with merge_reports(paths, pool) as output:
+        data = output.read()
+    finally:
+      if pool:
+        pool.shutdown()
+
+  elapsed = time.perf_counter() - start
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline # KB on linux, the merge workers are not counted
+
+  with zipfile.ZipFile(io.BytesIO(data)) as archive:
+    images = sum(1 for name in archive.namelist() if name.startswith("xl/media/"))
+
+  return elapsed, peak / 1024, len(data) / (1024 * 1024), images
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--reports", type=int, default=20)
+  parser.add_argument("--rows", type=int, default=200)
+  parser.add_argument("--workers", type=int, default=4)
+  args = parser.parse_args()
+
+  ctx = get_context("spawn")
+
+  with TemporaryDirectory(prefix="bench_merge_") as folder:
+    print(f"Making {args.reports} reports of {args.rows} rows...")
+    with ctx.Pool(1) as pool:
+      paths = pool.apply(make_reports, (folder, args.reports, args.rows))
+
+    print(f"{'method':<16} {'seconds':>8} {'peak MB':>9} {'out MB':>8} {'images':>7}")
+
+    cases = [("legacy", 0), ("engine", 0), ("engine", args.workers)]
+    for method, workers in cases:
+      # not a multiprocessing.Pool, its daemon workers can't start the merge workers
+      with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+        seconds, peak_mb, out_mb, images = pool.submit(run_case, paths, method, workers).result()
+
+      label = method if method == "legacy" else f"{method} x{workers}"
+      print(f"{label:<16} {seconds:8.2f} {peak_mb:9.1f} {out_mb:8.1f} {images:7d}")
+
+if __name__ == '__main__':
+  main()
\ No newline at end of file
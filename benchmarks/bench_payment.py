@@ -0,0 +1,82 @@
+"""
+Payment normalization benchmark: old clean_payment loop vs PaymentMatcher
+
+usage (from the repo root):
+  python -m benchmarks.bench_payment [rounds]
+"""
+from difflib import SequenceMatcher
+import time
+import sys
+
+# Modules
+from Back.core.matcher import load_payment_matcher
+
+# OCR-like payment fields (exact, misread, unknown)
+SAMPLES = [
+  "Nathealth", "NatHealth ", "nathelth", "Nathaelth",
+  "شخصي", "شخصى", "نقدي", "نقدى", "self",
+  "الخدمات الطبية العسكرية الفلسطينية", "الخدمات الطبيه العسكريه",
+  "وزارة الصحة", "وزاره الصحه", "التأمين الصحي", "التامين الصحى",
+  "Arab Orient", "MedNet", "GlobeMed", "Jordan Insurance", "-",
+]
+
+def legacy_clean_payment(text):
+  """
+  clean_payment before the matcher (rules rebuilt on every call)
+  """
+  if not text: return "-"
+  text_clean = text.strip()
+  text_lower = text.lower()
+
+  PAYMENT_RULES = [
+    ("Nathealth", "nathealth", 0.8, ["nat", "nathealth"]),
+    ("Cash", "شخصي", 0.7, ["شخص", "self"]),
+    ("Cash", "نقدي", 0.7, ["نقد"]),
+    ("الخدمات العسكرية", "الخدمات الطبية العسكرية الفلسطينية", 0.6, ["الفلسطينية"]),
+    ("التأمين الصحي", "وزارة الصحة", 0.6, ["وزارة", "الصحة"]),
+    ("التأمين الصحي", "التامين الصحي", 0.8, ["التأمين"]),
+  ]
+
+  for return_val, target_sim, threshold, keywords in PAYMENT_RULES:
+    if any(k in text_lower for k in keywords):
+      return return_val
+
+    if SequenceMatcher(None, text_clean, target_sim).ratio() > threshold:
+      return return_val
+
+  return text
+
+def bench(name, fn, rounds):
+  start = time.perf_counter()
+  for _ in range(rounds):
+    for sample in SAMPLES:
+      fn(sample)
+  elapsed = time.perf_counter() - start
+
+  rate = len(SAMPLES) * rounds / elapsed
+  print(f"{name:<16} {rate:12,.0f} strings/sec")
+  return rate
+
+def main():
+  rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+  matcher = load_payment_matcher()
+
+  legacy_rate = bench("legacy", legacy_clean_payment, rounds)
+
+  # no memoization -> cost of the index + normalization alone
+  cold_rate = bench("matcher (cold)", lambda t: matcher._match(t) or t, rounds)
+
+  # memoized, what the api sees with repeated strings
+  warm_rate = bench("matcher (cached)", lambda t: matcher.match(t) or t, rounds)
+
+  print(f"speedup: {cold_rate / legacy_rate:.1f}x cold, {warm_rate / legacy_rate:.1f}x cached")
+
+  # where the two disagree (arabic folding fixes some of the legacy misses)
+  for sample in SAMPLES:
+    old, new = legacy_clean_payment(sample), matcher.match(sample) or sample
+    if old != new:
+      print(f"  {sample!r}: {old!r} -> {new!r}")
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,75 @@
+"""
+Surgeon benchmark: per crop loop vs batched run_surgeon
+
+usage (from the repo root):
+  python -m benchmarks.bench_surgeon path/to/sheets_folder [rounds]
+"""
+from ultralytics import YOLO
+import time
+import sys
+import os
+import cv2
+
+# Modules
+from Back.core.pipeline import find_stickers, run_surgeon, HUNTER_MODEL_PATH, SURGEON_MODEL_PATH, SURGEON_BATCH_SIZE
+
+def load_crops(folder, hunter):
+  """
+  Runs the hunter on every sheet in the folder and keeps the non "other" crops
+  """
+  crops = []
+
+  for filename in sorted(os.listdir(folder)):
+    sheet = cv2.imread(os.path.join(folder, filename))
+    if sheet is None:
+      continue
+
+    try:
+      stickers = find_stickers(sheet, hunter, filename)
+    except Exception:
+      continue
+
+    crops.extend(s["crop"] for s in stickers if s["hospital_name"] != "other")
+
+  return crops
+
+def bench(name, fn, crops, rounds):
+  fn(crops) # warm up
+
+  start = time.perf_counter()
+  for _ in range(rounds):
+    fn(crops)
+  elapsed = time.perf_counter() - start
+
+  rate = len(crops) * rounds / elapsed
+  print(f"{name:<12} {rate:8.1f} stickers/sec ({elapsed / rounds * 1000:.1f} ms per round)")
+  return rate
+
+def main():
+  if len(sys.argv) < 2:
+    print(__doc__)
+    exit()
+
+  folder = sys.argv[1]
+  rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+  hunter = YOLO(HUNTER_MODEL_PATH)
+  surgeon = YOLO(SURGEON_MODEL_PATH)
+
+  crops = load_crops(folder, hunter)
+  if not crops:
+    print("Didn't find any stickers")
+    exit()
+
+  print(f"{len(crops)} stickers, batch size {SURGEON_BATCH_SIZE}, {rounds} rounds")
+
+  # 1- old path, one forward pass per sticker
+  loop_rate = bench("per crop", lambda c: [surgeon(crop, verbose=False) for crop in c], crops, rounds)
+
+  # 2- batched path
+  batch_rate = bench("batched", lambda c: run_surgeon(surgeon, c), crops, rounds)
+
+  print(f"speedup: {batch_rate / loop_rate:.2f}x")
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,145 @@
+from ultralytics import YOLO
+import easyocr
+import yaml
+import time
+import os
+import cv2
+
+# Modules
+from Back.core.pipeline import HUNTER_MODEL_PATH, SURGEON_MODEL_PATH, detect_stickers, crop_stickers, read_stickers
+from Back.core.report import excel_structure
+from Back.core.backends import export_path, box_iou
+
+# run from the repo root: python -m trainers.quantize
+MODELS = [
+  # (name, fp32 weights, calibration dataset)
+  ("hunter", HUNTER_MODEL_PATH, "./data.yaml"),
+  ("surgeon", SURGEON_MODEL_PATH, "./data_surgeon.yaml"),
+]
+
+REPORT_PATH = "./models/quantization_report.md"
+
+# the text columns compared between fp32 and int8
+TEXT_FIELDS = [col for col, _ in excel_structure if col not in ("Sticker image", "File Name")]
+
+def val_images(data_yaml):
+  """
+  Returns the paths of the validation images of a dataset yaml
+  """
+  with open(data_yaml) as f:
+    data = yaml.safe_load(f)
+
+  folder = os.path.join(data["path"], data["val"])
+  return [os.path.join(folder, name) for name in sorted(os.listdir(folder))]
+
+def quantize(weights, data_yaml):
+  """
+  Post training int8 quantization (openvino + nncf), calibrated on the dataset images
+  """
+  quantized = export_path(weights, "openvino", "int8")
+
+  if not os.path.exists(quantized):
+    print(f"Quantizing {weights} with {data_yaml}...")
+    quantized = YOLO(weights).export(format="openvino", int8=True, dynamic=True, data=data_yaml)
+
+  return quantized
+
+def latency(model, images):
+  """
+  Average cpu time per image in ms
+  """
+  model(images[0], device="cpu", verbose=False) # warm up
+
+  start = time.perf_counter()
+  for image in images:
+    model(image, device="cpu", verbose=False)
+
+  return (time.perf_counter() - start) / len(images) * 1000
+
+def evaluate(model, data_yaml, images):
+  metrics = model.val(data=data_yaml, device="cpu", verbose=False, plots=False)
+
+  return {
+    "mAP50": metrics.box.map50,
+    "mAP50-95": metrics.box.map,
+    "ms/image": latency(model, images),
+  }
+
+def read_sheet(image, filename, hunter, surgeon, reader):
+  """
+  Returns [(box, patient_row)] for a sheet
+  """
+  boxes = [(name, box) for name, box in detect_stickers(hunter, image)[0] if image[box[1]:box[3], box[0]:box[2]].size]
+  if not boxes:
+    return []
+
+  rows = read_stickers(crop_stickers(image, boxes, filename), surgeon, reader)
+  return [(box, row) for (_, box), row in zip(boxes, rows)]
+
+def ocr_agreement(paths, fp32, int8, reader):
+  """
+  Runs the whole pipeline with both precisions and compares the text fields
+  stickers are paired by their box (IoU >= 0.5), an unpaired sticker counts as disagreement
+  """
+  agree = total = 0
+
+  for path in paths:
+    image = cv2.imread(path)
+    if image is None:
+      continue
+
+    filename = os.path.basename(path)
+    expected = read_sheet(image, filename, *fp32, reader)
+    found = read_sheet(image, filename, *int8, reader)
+
+    for box, row in expected:
+      match = max(found, key=lambda f: box_iou(box, f[0]), default=None)
+      if match is not None and box_iou(box, match[0]) < 0.5:
+        match = None
+
+      for field in TEXT_FIELDS:
+        total += 1
+        if match is not None and match[1][field] == row[field]:
+          agree += 1
+
+  return agree, total
+
+def main():
+  lines = ["| model | precision | mAP50 | mAP50-95 | ms/image (cpu) |", "|---|---|---|---|---|"]
+  loaded = {}
+
+  # 1- quantize + evaluate every model
+  for name, weights, data_yaml in MODELS:
+    images = val_images(data_yaml)
+
+    fp32 = YOLO(weights)
+    int8 = YOLO(quantize(weights, data_yaml), task="detect")
+    loaded[name] = (fp32, int8)
+
+    for precision, model in (("fp32", fp32), ("int8", int8)):
+      result = evaluate(model, data_yaml, images)
+      lines.append(f"| {name} | {precision} | {result['mAP50']:.3f} | {result['mAP50-95']:.3f} | {result['ms/image']:.1f} |")
+      print(lines[-1])
+
+  # 2- end to end ocr agreement on the hunter validation sheets
+  print("Comparing OCR fields...")
+  reader = easyocr.Reader(['en', 'ar'], gpu=False)
+
+  fp32_models = (loaded["hunter"][0], loaded["surgeon"][0])
+  int8_models = (loaded["hunter"][1], loaded["surgeon"][1])
+
+  agree, total = ocr_agreement(val_images("./data.yaml"), fp32_models, int8_models, reader)
+  percent = agree / total * 100 if total else 0.0
+
+  lines.append("")
+  lines.append(f"OCR field agreement (int8 vs fp32): {percent:.1f}% ({agree}/{total} fields)")
+  print(lines[-1])
+
+  # 3- save the report
+  with open(REPORT_PATH, "w") as f:
+    f.write("\n".join(lines) + "\n")
+
+  print(f"Report saved to {REPORT_PATH}")
+
+if __name__ == '__main__':
+  main()